@@ -0,0 +1,687 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------------------------------
+# BHL - BlockHashLoc files library
+#
+# Created: 16/10/2026
+#
+# Copyright (C) 2017 Marco Pontello - http://mark0.net/
+#
+# Licence:
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#--------------------------------------------------------------------------
+
+"""Read and write BHL files & catalogs.
+
+    with open("file", "rb") as fin, open("file.bhl", "wb") as fout:
+        buildBHL(fin, fout, blocksize=4096, filename="file")
+
+    with BHLFile("file.bhl") as bhlfile:
+        for record in bhlfile.Records():
+            for num, digest, weak in record.Digests():
+                ...
+"""
+
+import os
+import hashlib
+import zlib
+import functools
+import copy
+import time
+import json
+import threading
+import contextlib
+
+BHL_VER = 3
+BHL_MAGIC = b"BlockHashLoc\x1a"
+CAT_MAGIC = b"BlockHashCat\x1a"
+CHUNK_SIZE = 16*1024*1024
+
+#block hash algorithms, all with 32 bytes digests
+HASH_ALGOS = {"sha256": hashlib.sha256,
+              "blake2b": functools.partial(hashlib.blake2b, digest_size=32),
+              "blake2s": hashlib.blake2s,
+              "sha3_256": hashlib.sha3_256}
+
+
+class BHLError(Exception):
+    """Invalid or corrupt BHL file, or a recovery that can't go on"""
+
+
+def entrySize(bhlver):
+    """Size of a hash list entry"""
+    return 36 if bhlver >= 2 else 32
+
+
+def trailerSize(bhlver):
+    """Size of the hashes after the hash list"""
+    return 64 if bhlver >= 2 else 32
+
+
+def metadataDecode(data):
+    """Decode metadata"""
+    metadata = {}
+    p = 0
+    while p < (len(data)-3):
+        metaid = data[p:p+3]
+        p+=3
+        metalen = data[p]
+        metabb = data[p+1:p+1+metalen]
+        p = p + 1 + metalen
+        if metaid == b'FNM':
+            metadata["filename"] = metabb.decode('utf-8')
+        elif metaid == b'FDT':
+            metadata["filedatetime"] = int.from_bytes(metabb, byteorder='big')
+        elif metaid == b'FPT':
+            #long paths are split in more fields
+            metadata["filepath"] = (metadata.get("filepath", "") +
+                                    metabb.decode('utf-8'))
+        elif metaid == b'HSH':
+            metadata["hashalgo"] = metabb.decode('utf-8')
+    return metadata
+
+
+def metadataEncode(filename="", filedatetime=None, filepath="",
+                   hashalgo="sha256"):
+    """Encode the metadata of a file, with its path in a catalog and the
+    block hash algorithm if not the default one"""
+    metadata = b""
+    bb = filename.encode()
+    metadata += b"FNM" + bytes([len(bb)]) + bb
+    if filedatetime is not None:
+        bb = int(filedatetime).to_bytes(8, byteorder='big')
+        metadata += b"FDT" + bytes([len(bb)]) + bb
+    #the path can be longer than a field: split it in more FPT
+    bb = filepath.replace(os.sep, "/").encode()
+    for p in range(0, len(bb), 255):
+        metadata += b"FPT" + bytes([len(bb[p:p+255])]) + bb[p:p+255]
+    if hashalgo != "sha256":
+        bb = hashalgo.encode()
+        metadata += b"HSH" + bytes([len(bb)]) + bb
+    return metadata
+
+
+def fillBuffer(fin, view):
+    """Read into a buffer until full or EOF - return the bytes read"""
+    filled = 0
+    while filled < len(view):
+        n = fin.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def hashBlocks(buffer, blocksize, bhlver, hashalgo="sha256"):
+    """Hash all the blocks in a buffer - return the BHL entries, the
+    digests and the weak checksums, each as a single bytes string"""
+    view = memoryview(buffer)
+    blockhash = HASH_ALGOS[hashalgo]
+    adler32 = zlib.adler32
+    digests = []
+    weaks = []
+    for p in range(0, len(view), blocksize):
+        block = view[p:p+blocksize]
+        digests.append(blockhash(block).digest())
+        if bhlver >= 2:
+            #rolling weak checksum, to let the scan skip most strong hashes
+            weaks.append(adler32(block).to_bytes(4, byteorder='big'))
+    if bhlver >= 2:
+        entries = b"".join([d + w for d, w in zip(digests, weaks)])
+    else:
+        entries = b"".join(digests)
+    return entries, b"".join(digests), b"".join(weaks)
+
+
+def writeHashes(fin, fout, filesize, blocksize, bhlver, hashalgo="sha256",
+                chunks=None, progress=None):
+    """Write the hash section of a file, with its last block remainder -
+    return the number of blocks, the size of the compressed remainder and
+    the file size. The hashBlocks results of all the blocks can come from
+    chunks, else they're read from fin: up to its end, without a filesize.
+    progress(bytes done, filesize) is called after each chunk."""
+    remainder = b""
+    readsize = 0
+
+    def readChunks():
+        nonlocal remainder, readsize
+        chunksize = max(CHUNK_SIZE // blocksize, 1) * blocksize
+        #no bigger than needed, with many small files
+        if filesize is not None:
+            chunksize = min(chunksize, max((filesize + blocksize - 1) //
+                                           blocksize, 1) * blocksize)
+        view = memoryview(bytearray(chunksize))
+        while filesize is None or readsize < filesize:
+            size = (chunksize if filesize is None else
+                    min(chunksize, filesize - readsize))
+            n = fillBuffer(fin, view[:size])
+            if n < size and filesize is not None:
+                raise BHLError("file shorter than expected")
+            readsize += n
+            if n % blocksize:
+                remainder = bytes(view[n - n % blocksize:n])
+            if n:
+                yield hashBlocks(view[:n], blocksize, bhlver, hashalgo)
+            if n < size:
+                break
+
+    readremainder = chunks is not None
+    if chunks is None:
+        chunks = readChunks()
+    elif filesize is None:
+        raise BHLError("the size of the stream is needed")
+
+    globalhash = HASH_ALGOS[hashalgo]()
+    weakhash = HASH_ALGOS[hashalgo]()
+    blocksnum = 0
+    for entries, digests, weaks in chunks:
+        fout.write(entries)
+        globalhash.update(digests)
+        weakhash.update(weaks)
+        blocksnum += len(digests) // 32
+        if progress:
+            if filesize is None:
+                progress(blocksnum * blocksize, None)
+            else:
+                progress(min(blocksnum * blocksize, filesize), filesize)
+    if filesize is None:
+        filesize = readsize
+    #only once the chunks are done, as they can be read lazily from fin
+    if readremainder and filesize % blocksize:
+        fin.seek(filesize - filesize % blocksize)
+        remainder = fin.read(filesize % blocksize)
+
+    #write hash of hashes and block remainder (if present)
+    bufferz = zlib.compress(remainder, 9) if remainder else b""
+    fout.write(globalhash.digest())
+    if bhlver >= 2:
+        fout.write(weakhash.digest())
+    fout.write(bufferz)
+    return blocksnum, len(bufferz), filesize
+
+
+class BHLWriter():
+    """Write a BHL file, or a BHL catalog of many files, to a stream"""
+
+    def __init__(self, fout, blocksize=512, bhlver=2, hashalgo="sha256",
+                 catalog=False):
+        if hashalgo not in HASH_ALGOS:
+            raise BHLError("hash algorithm '%s' not supported" % hashalgo)
+        #BHL v3 records the block hash algorithm
+        if hashalgo != "sha256":
+            if bhlver < 2:
+                raise BHLError("hash algorithm '%s' needs BHL v3" % hashalgo)
+            bhlver = 3
+        self.fout = fout
+        self.blocksize = blocksize
+        self.bhlver = bhlver
+        self.hashalgo = hashalgo
+        self.catalog = catalog
+        self.filetable = []
+        self.filesnum = 0
+        self.blocksnum = 0
+        self.datasize = 0
+
+        #write header (with a catalog files count and file table position
+        #filled in at the end)
+        fout.write(CAT_MAGIC if catalog else BHL_MAGIC)
+        fout.write(bytes([bhlver]))
+        fout.write(blocksize.to_bytes(4, byteorder='big', signed=False))
+        if catalog:
+            fout.write(bytes(16))
+
+    def AddFile(self, fin, filesize, filename="", filedatetime=None,
+                filepath="", chunks=None, progress=None):
+        """Add a file, read from a stream at its start - return the number of
+        blocks and the size of the compressed last block remainder. Without
+        a filesize the stream is read up to its end, and in a BHL file the
+        size is filled in afterwards. See writeHashes for chunks and
+        progress."""
+        fout = self.fout
+        if not self.catalog:
+            if self.filesnum:
+                raise BHLError("a BHL file can hold a single file")
+            sizepos = None
+            if filesize is None:
+                if not fout.seekable():
+                    raise BHLError("the size of the stream is needed")
+                sizepos = fout.tell()
+            fout.write((filesize or 0).to_bytes(8, byteorder='big',
+                                                signed=False))
+            metadata = metadataEncode(filename, filedatetime,
+                                      hashalgo=self.hashalgo)
+            fout.write(len(metadata).to_bytes(4, byteorder='big') + metadata)
+            blocksnum, lastsize, filesize = writeHashes(fin, fout, filesize,
+                                                        self.blocksize,
+                                                        self.bhlver,
+                                                        self.hashalgo, chunks,
+                                                        progress)
+            if sizepos is not None:
+                fout.seek(sizepos)
+                fout.write(filesize.to_bytes(8, byteorder='big', signed=False))
+                fout.seek(0, os.SEEK_END)
+        else:
+            recpos = fout.tell()
+            try:
+                blocksnum, lastsize, filesize = writeHashes(fin, fout,
+                                                            filesize,
+                                                            self.blocksize,
+                                                            self.bhlver,
+                                                            self.hashalgo,
+                                                            chunks, progress)
+            except Exception:
+                #drop what was written of the failed record
+                fout.seek(recpos)
+                fout.truncate()
+                raise
+            self.addEntry(recpos, filesize, lastsize, filename, filedatetime,
+                          filepath)
+        self.filesnum += 1
+        self.blocksnum += blocksnum
+        self.datasize += filesize
+        return blocksnum, lastsize
+
+    def AddRecord(self, record, filesize, blocksnum, lastsize, filename="",
+                  filedatetime=None, filepath=""):
+        """Add a file to a catalog, with its hash section already made"""
+        recpos = self.fout.tell()
+        self.fout.write(record)
+        self.addEntry(recpos, filesize, lastsize, filename, filedatetime,
+                      filepath)
+        self.filesnum += 1
+        self.blocksnum += blocksnum
+        self.datasize += filesize
+
+    def addEntry(self, recpos, filesize, lastsize, filename, filedatetime,
+                 filepath):
+        metadata = metadataEncode(filename, filedatetime, filepath,
+                                  self.hashalgo)
+        self.filetable.append(filesize.to_bytes(8, byteorder='big') +
+                              recpos.to_bytes(8, byteorder='big') +
+                              lastsize.to_bytes(4, byteorder='big') +
+                              len(metadata).to_bytes(4, byteorder='big') +
+                              metadata)
+
+    def Close(self):
+        """Complete a catalog, with its file table (the stream is left open)"""
+        if not self.catalog:
+            return
+        #write the file table, with its hash, and complete the header
+        fout = self.fout
+        tablepos = fout.tell()
+        filetable = b"".join(self.filetable)
+        fout.write(filetable)
+        fout.write(hashlib.sha256(filetable).digest())
+        fout.seek(len(CAT_MAGIC) + 5)
+        fout.write(self.filesnum.to_bytes(8, byteorder='big'))
+        fout.write(tablepos.to_bytes(8, byteorder='big'))
+        fout.seek(0, os.SEEK_END)
+
+
+def buildBHL(fin, fout, blocksize=512, filesize=None, filename="",
+             filedatetime=None, bhlver=2, hashalgo="sha256", progress=None):
+    """Write the BHL file of a stream, from where it's positioned - return
+    the number of blocks. Without a filesize, the stream is read up to its
+    end: in a single pass if it can't seek (pipes, sockets, etc.), with the
+    size filled in afterwards."""
+    if filesize is None:
+        try:
+            pos = fin.tell()
+            filesize = fin.seek(0, os.SEEK_END) - pos
+            fin.seek(pos)
+        except (AttributeError, OSError):
+            filesize = None
+    writer = BHLWriter(fout, blocksize, bhlver, hashalgo)
+    blocksnum = writer.AddFile(fin, filesize, filename, filedatetime,
+                               progress=progress)[0]
+    writer.Close()
+    return blocksnum
+
+
+class BHLRecord():
+    """A file in a BHL file or catalog - its hashes are read only when asked
+    for, from the stream of the BHL file"""
+
+    def __init__(self, bhlfile, filesize, metadata, hashespos, lastsize):
+        self.bhlfile = bhlfile
+        self.version = bhlfile.version
+        self.blocksize = bhlfile.blocksize
+        self.filesize = filesize
+        self.metadata = metadata
+        self.hashespos = hashespos
+        self.lastsize = lastsize
+        self.entrysize = entrySize(self.version)
+        self.blocksnum = (filesize + self.blocksize-1) // self.blocksize
+        self.hashalgo = metadata.get("hashalgo", "sha256")
+        if self.hashalgo not in HASH_ALGOS:
+            raise BHLError("hash algorithm '%s' not supported" % self.hashalgo)
+        #files in a catalog are rebuilt in their own path
+        self.filename = metadata.get("filename", "")
+        if metadata.get("filepath"):
+            self.filename = os.path.join(
+                *[part for part in metadata["filepath"].split("/")
+                  if part not in ["", ".", ".."]] + [self.filename])
+
+    def Entries(self, blocksnum=None, chunksize=4*1024*1024):
+        """Read the hash list entries of the first blocksnum blocks (all by
+        default) a chunk at a time - yield views on a single reused buffer"""
+        fin = self.bhlfile.fin
+        fin.seek(self.hashespos)
+        size = (self.blocksnum if blocksnum is None else blocksnum) * self.entrysize
+        #no bigger than needed, as a catalog can have many small files
+        view = memoryview(bytearray(min(max(chunksize // self.entrysize, 1) *
+                                        self.entrysize, size)))
+        while size > 0:
+            n = min(size, len(view))
+            if fillBuffer(fin, view[:n]) < n:
+                raise BHLError("hashes block corrupt!")
+            size -= n
+            yield view[:n]
+
+    def Digests(self, progress=None):
+        """Yield (num, digest, weak) for all the blocks, with weak as None for
+        BHL v1, then check them against the hashes of hashes.
+        progress(bytes read, BHL file size) is called after each chunk."""
+        fin = self.bhlfile.fin
+        globalhash = HASH_ALGOS[self.hashalgo]()
+        weakhash = HASH_ALGOS[self.hashalgo]()
+        num = 0
+        for chunk in self.Entries():
+            if self.version < 2:
+                globalhash.update(chunk)
+                for p in range(0, len(chunk), 32):
+                    yield num, bytes(chunk[p:p+32]), None
+                    num += 1
+            else:
+                for p in range(0, len(chunk), 36):
+                    digest = bytes(chunk[p:p+32])
+                    globalhash.update(digest)
+                    weakhash.update(chunk[p+32:p+36])
+                    yield num, digest, int.from_bytes(chunk[p+32:p+36],
+                                                      byteorder='big')
+                    num += 1
+            if progress:
+                progress(fin.tell(), self.bhlfile.size)
+
+        #verify the hashes read
+        fin.seek(self.hashespos + self.blocksnum * self.entrysize)
+        if globalhash.digest() != fin.read(32):
+            raise BHLError("hashes block corrupt!")
+        if self.version >= 2:
+            if weakhash.digest() != fin.read(32):
+                raise BHLError("weak checksums block corrupt!")
+
+    def Digest(self, num):
+        """Digest of a block"""
+        fin = self.bhlfile.fin
+        fin.seek(self.hashespos + num * self.entrysize)
+        return fin.read(32)
+
+    def Hash(self):
+        """Hash of all the block hashes"""
+        return self.Digest(self.blocksnum)
+
+    def Verify(self, fin, progress=None, chunksize=CHUNK_SIZE):
+        """Compare a file, read from its start, with the block hashes - return
+        the damaged blocks as a list of (first, last) ranges, empty if the
+        file is intact (the blocks missing from a short file are damaged
+        too). progress(bytes read, file size) is called after each chunk."""
+        blocksize = self.blocksize
+        entrysize = self.entrysize
+        #no bigger than needed, as a catalog can have many small files
+        chunkblocks = max(min(chunksize // blocksize, self.blocksnum), 1)
+        view = memoryview(bytearray(chunkblocks * blocksize))
+        globalhash = HASH_ALGOS[self.hashalgo]()
+        damaged = []
+        num = 0
+        for entries in self.Entries(chunksize=chunkblocks * entrysize):
+            entries = entries.tobytes()
+            blocksnum = len(entries) // entrysize
+            size = min(blocksnum * blocksize, self.filesize - num * blocksize)
+            datalen = fillBuffer(fin, view[:size])
+            fileentries = hashBlocks(view[:datalen], blocksize, self.version,
+                                     self.hashalgo)[0]
+            if self.version >= 2:
+                digests = b"".join([entries[p:p+32]
+                                    for p in range(0, len(entries), 36)])
+            else:
+                digests = entries
+            globalhash.update(digests)
+            #the whole chunk at once, block by block only if it differs
+            if fileentries != entries:
+                for i in range(blocksnum):
+                    p = i * entrysize
+                    if fileentries[p:p+32] != entries[p:p+32]:
+                        if damaged and damaged[-1][1] == num + i - 1:
+                            damaged[-1] = (damaged[-1][0], num + i)
+                        else:
+                            damaged.append((num + i, num + i))
+            num += blocksnum
+            if progress:
+                progress(min(num * blocksize, self.filesize), self.filesize)
+
+        #damage could be in the BHL file instead
+        if globalhash.digest() != self.Hash():
+            raise BHLError("hashes block corrupt!")
+        return damaged
+
+    def LastBlock(self):
+        """Last block remainder (b"" if none), checked against its digest"""
+        if not self.filesize % self.blocksize:
+            return b""
+        digest = self.Digest(self.blocksnum - 1)
+        fin = self.bhlfile.fin
+        fin.seek(self.hashespos + self.blocksnum * self.entrysize +
+                 trailerSize(self.version))
+        try:
+            lastblock = zlib.decompress(fin.read(self.lastsize))
+        except zlib.error:
+            raise BHLError("last block corrupt!")
+        if HASH_ALGOS[self.hashalgo](lastblock).digest() != digest:
+            raise BHLError("last block corrupt!")
+        return lastblock
+
+
+class BHLFile():
+    """A BHL file or catalog, opened for reading"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.fin = open(filename, "rb", buffering=1024*1024)
+        try:
+            magic = self.fin.read(13)
+            if magic not in [BHL_MAGIC, CAT_MAGIC]:
+                raise BHLError("not a valid BHL file")
+            self.catalog = magic == CAT_MAGIC
+            #check ver
+            self.version = ord(self.fin.read(1))
+            if self.version > BHL_VER:
+                raise BHLError("BHL version %i not supported" % self.version)
+            self.blocksize = int.from_bytes(self.fin.read(4), byteorder='big')
+            if self.catalog:
+                self.filesnum = int.from_bytes(self.fin.read(8), byteorder='big')
+                self.tablepos = int.from_bytes(self.fin.read(8), byteorder='big')
+            else:
+                self.filesnum = 1
+        except Exception:
+            self.fin.close()
+            raise
+
+    def Close(self):
+        self.fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+    def Records(self):
+        """Yield a BHLRecord for each file"""
+        fin = self.fin
+        if not self.catalog:
+            fin.seek(18)
+            filesize = int.from_bytes(fin.read(8), byteorder='big')
+            #parse metadata section
+            metasize = int.from_bytes(fin.read(4), byteorder='big')
+            metadata = metadataDecode(fin.read(metasize))
+            #the compressed last block takes what's left after the hashes
+            hashespos = fin.tell()
+            blocksnum = (filesize + self.blocksize-1) // self.blocksize
+            lastsize = (self.size - hashespos - blocksnum * entrySize(self.version) -
+                        trailerSize(self.version))
+            yield BHLRecord(self, filesize, metadata, hashespos, lastsize)
+            return
+
+        fin.seek(self.tablepos)
+        filetable = fin.read(self.size - self.tablepos - 32)
+        if hashlib.sha256(filetable).digest() != fin.read(32):
+            raise BHLError("file table corrupt!")
+        p = 0
+        for fnum in range(self.filesnum):
+            filesize = int.from_bytes(filetable[p:p+8], byteorder='big')
+            recpos = int.from_bytes(filetable[p+8:p+16], byteorder='big')
+            lastsize = int.from_bytes(filetable[p+16:p+20], byteorder='big')
+            metasize = int.from_bytes(filetable[p+20:p+24], byteorder='big')
+            metadata = metadataDecode(filetable[p+24:p+24+metasize])
+            p += 24 + metasize
+            yield BHLRecord(self, filesize, metadata, recpos, lastsize)
+
+    def Fingerprint(self):
+        """Bytes identifying the file, from its header and hash of hashes (of
+        the file table, for a catalog)"""
+        fin = self.fin
+        fin.seek(0)
+        if self.catalog:
+            header = fin.read(34)
+            fin.seek(-32, os.SEEK_END)
+            return header + fin.read(32)
+        header = fin.read(26)
+        return header + next(self.Records()).Hash()
+
+
+class Stats():
+    """Where the time goes: wall & CPU time of each phase, counts of events,
+    and throughput over time - for a --stats report.
+
+        with stats.Phase("scan", imgfilename):
+            ...
+            stats.Count("bytes read", len(data))
+            stats.Sample("scan", pos)
+
+    Nested phases are accounted exclusively: the time of an inner phase is
+    taken out of the outer one. CPU time is of the whole process (all its
+    threads), without the worker processes, which are in the report total
+    only."""
+
+    def __init__(self, interval=1.0):
+        self.starttime = time.perf_counter()
+        self.startcpu = time.process_time()
+        times = os.times()
+        self.startchildren = times.children_user + times.children_system
+        self.phases = {}
+        self.counts = {}
+        self.series = []
+        self.interval = interval
+        self.nextsample = {}
+        self.lock = threading.Lock()
+        #phases open in each thread, with the time of their inner phases
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def Phase(self, name, item=None):
+        """Account the time spent in the block to a phase, and to an item
+        of it (a file, an image...) if given"""
+        stack = self.local.__dict__.setdefault("stack", [])
+        frame = [0, 0]
+        stack.append(frame)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            #phases in generators can end out of order
+            i = max([i for i in range(len(stack)) if stack[i] is frame])
+            del stack[i]
+            if i:
+                stack[i-1][0] += wall
+                stack[i-1][1] += cpu
+            wall -= frame[0]
+            cpu -= frame[1]
+            with self.lock:
+                phase = self.phases.setdefault(name, {"wall": 0, "cpu": 0,
+                                                      "calls": 0})
+                phase["wall"] += wall
+                phase["cpu"] += cpu
+                phase["calls"] += 1
+                if item is not None:
+                    items = phase.setdefault("items", {})
+                    times = items.setdefault(str(item), {"wall": 0, "cpu": 0})
+                    times["wall"] += wall
+                    times["cpu"] += cpu
+
+    def Count(self, name, num=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + num
+
+    def Add(self, counts):
+        """Add up a dict of counts"""
+        with self.lock:
+            for name, num in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + num
+
+    def Sample(self, name, value, now=None):
+        """Record the progress of something (bytes done, etc.), at most
+        once per interval"""
+        if now is None:
+            now = time.perf_counter()
+        if now < self.nextsample.get(name, 0):
+            return
+        self.nextsample[name] = now + self.interval
+        with self.lock:
+            self.series.append((now - self.starttime, name, value))
+
+    def Report(self):
+        """The stats as a dict, with the rate of each sample from the
+        previous one of the same name"""
+        series = []
+        last = {}
+        with self.lock:
+            for t, name, value in self.series:
+                sample = {"time": round(t, 3), "name": name, "value": value}
+                if name in last:
+                    lt, lvalue = last[name]
+                    sample["rate"] = (value - lvalue) / max(t - lt, 1e-9)
+                last[name] = (t, value)
+                series.append(sample)
+            times = os.times()
+            return {"wall": time.perf_counter() - self.starttime,
+                    "cpu": time.process_time() - self.startcpu,
+                    #worker processes, once they are done
+                    "children cpu": (times.children_user + times.children_system -
+                                     self.startchildren),
+                    "phases": copy.deepcopy(self.phases),
+                    "counts": dict(self.counts),
+                    "series": series}
+
+    def Save(self, filename, **info):
+        """Write the report to a JSON file, with some extra info"""
+        report = dict(info)
+        report.update(self.Report())
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+#--------------------------------------------------------------------------
+# BHLBench - BlockHashLoc Benchmark
+#
+# Created: 16/10/2026
+#
+# Copyright (C) 2017 Marco Pontello - http://mark0.net/
+#
+# Licence:
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#--------------------------------------------------------------------------
+
+import os
+import argparse
+import random
+import json
+import math
+import shutil
+import platform
+from time import perf_counter, process_time
+
+from bhl import HASH_ALGOS, buildBHL
+from bhlreco import Recovery, testBHL, PROGRAM_VER as RECO_VER
+
+PROGRAM_VER = "0.2.0b"
+
+#granularity of the files extents, like a filesystem cluster
+CLUSTER = 4096
+
+def get_cmdline():
+    """Evaluate command line parameters, usage & help."""
+    parser = argparse.ArgumentParser(
+             description="measure BlockHashLoc hashing speed",
+             formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+             prefix_chars='-')
+    parser.add_argument("-v", "--version", action='version',
+                        version='BlockHashLoc ' +
+                        'Benchmark v%s - (C) 2017 by M.Pontello' % PROGRAM_VER)
+    parser.add_argument("-b", "--blocksize", type=int, nargs="+",
+                        default=[512, 4096], help="blocks sizes", metavar="n")
+    parser.add_argument("--hash", action="store", nargs="+",
+                        choices=sorted(HASH_ALGOS), dest="hashalgos",
+                        help="block hash algorithms (default all for the " +
+                        "hashing test, sha256 for the recovery one)")
+    parser.add_argument("-s", "--size", type=int, default=64,
+                        help="data to hash for each test, in MB", metavar="n")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs for each test (the best one counts)",
+                        metavar="n")
+    parser.add_argument("-i", "--image", type=int, default=0,
+                        help="run the recovery test on an image of n MB",
+                        metavar="n")
+    parser.add_argument("-w", "--workdir", type=str, default="bhlbench",
+                        help="where to keep test files & image (reused " +
+                        "if generated with the same parameters)",
+                        metavar="path")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed for the test data", metavar="n")
+    parser.add_argument("-a", "--align", type=int, default=512,
+                        help="alignment of the fragments in the image",
+                        metavar="n")
+    parser.add_argument("--noise", type=float, default=20,
+                        help="percentage of the image with random data",
+                        metavar="n")
+    parser.add_argument("--zero", type=float, default=10,
+                        help="percentage of the image with zeroes",
+                        metavar="n")
+    parser.add_argument("--lost", type=float, default=1,
+                        help="percentage of files extents left out of " +
+                        "the image", metavar="n")
+    parser.add_argument("-db", "--database", type=str, default=":memory:",
+                        help="recovery DB (see bhlreco)", metavar="filename",
+                        dest="dbfilename")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="recovery scan processes", metavar="n")
+    parser.add_argument("-sk", "--skipahead", action="store_true",
+                        default=False, help="recovery skip-ahead scan")
+    parser.add_argument("-dc", "--dropcaches", action="store_true",
+                        default=False,
+                        help="drop the OS caches before each phase " +
+                        "(Linux, needs root)")
+    parser.add_argument("-o", "--output", type=str, default="",
+                        help="write the results to a JSON file",
+                        metavar="filename")
+    res = parser.parse_args()
+    return res
+
+
+def hashSpeed(blockhash, data, blocksize, repeat):
+    """Hash data a block at a time, as bhlmake and bhlreco do - return the
+    best speed in MB/s"""
+    view = memoryview(data)
+    besttime = None
+    for run in range(repeat):
+        starttime = perf_counter()
+        for p in range(0, len(view), blocksize):
+            blockhash(view[p:p+blocksize]).digest()
+        etime = perf_counter() - starttime
+        if besttime is None or etime < besttime:
+            besttime = etime
+    return len(data) / (1024*1024) / max(besttime, 1e-9)
+
+
+def hashTest(cmdline):
+    """Hashing speed for each algorithm and block size"""
+    data = os.urandom(cmdline.size * 1024 * 1024)
+    hashalgos = cmdline.hashalgos or sorted(HASH_ALGOS)
+    results = []
+
+    print("%-10s" % "hash" +
+          "".join(["%12s" % ("%i B" % blocksize)
+                   for blocksize in cmdline.blocksize]))
+    for hashalgo in hashalgos:
+        print("%-10s" % hashalgo, end="", flush=True)
+        for blocksize in cmdline.blocksize:
+            speed = hashSpeed(HASH_ALGOS[hashalgo], data, blocksize,
+                              cmdline.repeat)
+            print("%12s" % ("%.1f MB/s" % speed), end="", flush=True)
+            results.append({"hash": hashalgo, "blocksize": blocksize,
+                            "mbs": speed})
+        print()
+    return {"test": "hash", "size": cmdline.size * 1024 * 1024,
+            "hashes": results}
+
+
+def randomData(rnd, size):
+    """Reproducible random bytes"""
+    return rnd.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def makeFiles(path, rnd, totsize):
+    """Create random files for about totsize bytes, of assorted sizes, some
+    with zeroed regions - return the list of (filename, size)"""
+    os.makedirs(path, exist_ok=True)
+    maxsize = min(max(totsize // 16, 1024*1024), 1024*1024*1024)
+    files = []
+    while totsize > 0:
+        #log-uniform sizes, most not a multiple of any block size
+        filesize = int(math.exp(rnd.uniform(math.log(1024),
+                                            math.log(maxsize))))
+        filesize = min(filesize, totsize)
+        filename = os.path.join(path, "file%05i.bin" % len(files))
+        zeropos = zerosize = 0
+        if rnd.randrange(8) == 0:
+            zerosize = rnd.randrange(filesize // 2 + 1) // CLUSTER * CLUSTER
+            zeropos = rnd.randrange(filesize - zerosize + 1)
+        with open(filename, "wb") as fout:
+            pos = 0
+            while pos < filesize:
+                if zeropos <= pos < zeropos + zerosize:
+                    size = min(zeropos + zerosize - pos, 16*1024*1024)
+                    fout.write(bytes(size))
+                else:
+                    end = zeropos if pos < zeropos else filesize
+                    size = min(end - pos, 16*1024*1024)
+                    fout.write(randomData(rnd, size))
+                pos += size
+        files.append((filename, filesize))
+        totsize -= filesize
+    return files
+
+
+def makeImage(imgfilename, rnd, files, noisesize, zerosize, align, lost):
+    """Scatter the files extents in an image, shuffled among random data and
+    zeroes, every piece starting at a multiple of align - return the number
+    of extents written and lost"""
+    pieces = []
+    for fid, (filename, filesize) in enumerate(files):
+        pos = 0
+        while pos < filesize:
+            size = rnd.randrange(1, 256) * CLUSTER
+            size = min(size, filesize - pos)
+            pieces.append((fid, pos, size))
+            pos += size
+    extents = len(pieces)
+    #extents that went missing, overwritten by random data
+    lostnum = int(extents * lost / 100)
+    for i in rnd.sample(range(extents), lostnum):
+        pieces[i] = (-1, 0, pieces[i][2])
+    for piecesize, kind in [(noisesize, -1), (zerosize, -2)]:
+        while piecesize > 0:
+            size = min(rnd.randrange(1, 8*1024*1024), piecesize)
+            pieces.append((kind, 0, size))
+            piecesize -= size
+    rnd.shuffle(pieces)
+
+    with open(imgfilename, "wb") as fout:
+        pos = 0
+        for fid, filepos, size in pieces:
+            if fid >= 0:
+                with open(files[fid][0], "rb") as fin:
+                    fin.seek(filepos)
+                    fout.write(fin.read(size))
+            elif fid == -1:
+                for p in range(0, size, 16*1024*1024):
+                    fout.write(randomData(rnd, min(size - p, 16*1024*1024)))
+            else:
+                fout.write(bytes(size))
+            pos += size
+            if pos % align:
+                fout.write(randomData(rnd, align - pos % align))
+                pos += align - pos % align
+    return extents, lostnum
+
+
+def dropCaches():
+    """Make the next reads come from the disk, if possible"""
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3")
+    except (OSError, AttributeError):
+        print("can't drop the OS caches!")
+
+
+class Phase():
+    """Wall and CPU time of a benchmark phase"""
+
+    def __init__(self, dropcaches=False):
+        if dropcaches:
+            dropCaches()
+        self.wall = perf_counter()
+        self.cpu = process_time()
+
+    def Stop(self, **info):
+        info["time"] = perf_counter() - self.wall
+        info["cpu"] = process_time() - self.cpu
+        return info
+
+
+def mbs(size, phase):
+    return size / (1024*1024) / max(phase["time"], 1e-9)
+
+
+def recoveryTest(cmdline):
+    """Build the BHL files, then recover the files from a fragmented image,
+    timing each phase, for each block size"""
+    imgsize = cmdline.image * 1024 * 1024
+    params = {"version": PROGRAM_VER, "image": imgsize, "seed": cmdline.seed,
+              "align": cmdline.align, "noise": cmdline.noise,
+              "zero": cmdline.zero, "lost": cmdline.lost}
+    workdir = cmdline.workdir
+    filespath = os.path.join(workdir, "files")
+    imgfilename = os.path.join(workdir, "disk.img")
+    infofilename = os.path.join(workdir, "bhlbench.json")
+
+    #generate the test data, unless already there
+    info = None
+    if os.path.exists(infofilename):
+        with open(infofilename) as f:
+            info = json.load(f)
+        if info["params"] != params:
+            info = None
+    if info:
+        print("using image '%s'..." % imgfilename)
+    else:
+        print("creating test files...")
+        if os.path.exists(filespath):
+            shutil.rmtree(filespath)
+        rnd = random.Random(cmdline.seed)
+        noisesize = int(imgsize * cmdline.noise / 100)
+        zerosize = int(imgsize * cmdline.zero / 100)
+        phase = Phase()
+        files = makeFiles(filespath, rnd, imgsize - noisesize - zerosize)
+        print("creating image '%s'..." % imgfilename)
+        extents, lostnum = makeImage(imgfilename, rnd, files, noisesize,
+                                     zerosize, cmdline.align, cmdline.lost)
+        info = {"params": params, "files": files,
+                "filesize": sum([filesize for filename, filesize in files]),
+                "imgsize": os.path.getsize(imgfilename),
+                "extents": extents, "lost": lostnum,
+                "gentime": phase.Stop()["time"]}
+        with open(infofilename, "w") as f:
+            json.dump(info, f)
+    files = info["files"]
+    print("image: %.1fMB - files: %i, %.1fMB - extents: %i, lost: %i" %
+          (info["imgsize"] / (1024*1024), len(files),
+           info["filesize"] / (1024*1024), info["extents"], info["lost"]))
+
+    runs = []
+    for hashalgo in cmdline.hashalgos or ["sha256"]:
+        for blocksize in cmdline.blocksize:
+            print("blocksize: %i - hash: %s" % (blocksize, hashalgo))
+            run = {"blocksize": blocksize, "hash": hashalgo,
+                   "step": math.gcd(blocksize, cmdline.align)}
+            bhlpath = os.path.join(workdir, "bhl%i-%s" % (blocksize, hashalgo))
+            destpath = os.path.join(workdir, "out")
+            for path in [bhlpath, destpath]:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                os.makedirs(path)
+
+            #bhlmake
+            bhlfilenames = []
+            phase = Phase(cmdline.dropcaches)
+            for filename, filesize in files:
+                bhlfilename = os.path.join(bhlpath,
+                                           os.path.basename(filename) + ".bhl")
+                with open(filename, "rb") as fin, open(bhlfilename, "wb") as fout:
+                    buildBHL(fin, fout, blocksize=blocksize, filesize=filesize,
+                             filename=os.path.basename(filename),
+                             bhlver=3 if hashalgo != "sha256" else 2,
+                             hashalgo=hashalgo)
+                bhlfilenames.append(bhlfilename)
+            run["make"] = phase.Stop()
+            run["make"]["mbs"] = mbs(info["filesize"], run["make"])
+            bhlsize = sum([os.path.getsize(f) for f in bhlfilenames])
+            run["bhlsize"] = bhlsize
+
+            #BHL files read & check alone
+            phase = Phase(cmdline.dropcaches)
+            for bhlfilename in bhlfilenames:
+                testBHL(bhlfilename)
+            run["load"] = phase.Stop()
+            run["load"]["mbs"] = mbs(bhlsize, run["load"])
+
+            #BHL files read in the DB, and indexed
+            phase = Phase(cmdline.dropcaches)
+            rec = Recovery(bhlfilenames, cmdline.dbfilename)
+            for bhlfilename in bhlfilenames:
+                rec.AddBHL(bhlfilename)
+            rec.StartScan([imgfilename], step=run["step"], jobs=cmdline.jobs,
+                          skipahead=cmdline.skipahead)
+            run["dbfill"] = phase.Stop(blocks=rec.globalblocksnum)
+
+            #scan, the whole image unless all the blocks are found
+            status = {}
+            def getStatus(imgstatus):
+                status.update(imgstatus)
+            phase = Phase(cmdline.dropcaches)
+            for match in rec.Scan(progress=getStatus):
+                pass
+            scanned = int(status.get(0, (100, 0))[0] * info["imgsize"] / 100)
+            run["scan"] = phase.Stop(bytes=scanned, found=rec.blocksfound)
+            run["scan"]["mbs"] = mbs(scanned, run["scan"])
+
+            phase = Phase(cmdline.dropcaches)
+            restored, witherrors, missing = rec.Rebuild(destpath)
+            rec.Close()
+            run["rebuild"] = phase.Stop(restored=restored,
+                                        witherrors=witherrors, missing=missing)
+            #hashes, lookups, false hits, etc.
+            run["counts"] = rec.stats.Report()["counts"]
+            shutil.rmtree(destpath)
+
+            print("  make: %.1fs %.1fMB/s - load: %.1fs %.1fMB/s - db: %.1fs" %
+                  (run["make"]["time"], run["make"]["mbs"],
+                   run["load"]["time"], run["load"]["mbs"],
+                   run["dbfill"]["time"]))
+            print("  scan: %.1fs %.1fMB/s - found: %i/%i" %
+                  (run["scan"]["time"], run["scan"]["mbs"],
+                   rec.blocksfound, rec.globalblocksnum))
+            print("  rebuild: %.1fs - restored: %i - with errors: %i - missing: %i" %
+                  (run["rebuild"]["time"], restored, witherrors, missing))
+            runs.append(run)
+
+    return {"test": "recovery", "params": params,
+            "image": {key: info[key] for key in
+                      ["imgsize", "filesize", "extents", "lost"]},
+            "files": len(files), "db": cmdline.dbfilename,
+            "jobs": cmdline.jobs, "skipahead": cmdline.skipahead,
+            "runs": runs}
+
+
+def main():
+
+    cmdline = get_cmdline()
+
+    if cmdline.image:
+        results = recoveryTest(cmdline)
+    else:
+        results = hashTest(cmdline)
+
+    if cmdline.output:
+        results.update({"version": PROGRAM_VER, "bhlreco": RECO_VER,
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count()})
+        with open(cmdline.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
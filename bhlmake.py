@@ -25,14 +25,21 @@
 
 import os
 import sys
-import hashlib
+import io
 import argparse
 from time import time
-import zlib
 import fnmatch
+import multiprocessing
+import itertools
+import atexit
+import cProfile
+import tarfile
+
+from bhl import (BHLError, BHLFile, BHLWriter, HASH_ALGOS, CHUNK_SIZE, Stats,
+                 hashBlocks, writeHashes)
 
 PROGRAM_VER = "0.7.1b"
-BHL_VER = 1
+BHL_VER = 2
 
 def get_cmdline():
     """Evaluate command line parameters, usage & help."""
@@ -44,7 +51,7 @@ def get_cmdline():
                         version='BlockHashLoc ' +
                         'Maker v%s - (C) 2017 by M.Pontello' % PROGRAM_VER) 
     parser.add_argument("filename", action="store", nargs="+",
-                        help="file to process")
+                        help="file to process ('-' for stdin)")
     parser.add_argument("-d", action="store", dest="destpath",
                         help="destination path", default="", metavar="path")
     parser.add_argument("-b", "--blocksize", type=int, default=512,
@@ -52,7 +59,33 @@ def get_cmdline():
     parser.add_argument("-c", "--continue", action="store_true", default=False,
                         help="continue on block errors", dest="cont")
     parser.add_argument("-r", "--recurse", action="store_true", default=False,
-                        help="recurse subdirs")
+                        help="recurse subdirs, creating a single BHL catalog")
+    parser.add_argument("-cat", "--catalog", action="store", default="",
+                        help="BHL catalog file name (default from the dir name)",
+                        metavar="filename")
+    parser.add_argument("-bv", "--bhlver", type=int, default=BHL_VER,
+                        choices=[1, 2], help="BHL format version")
+    parser.add_argument("--hash", action="store", default="sha256",
+                        choices=sorted(HASH_ALGOS), dest="hashalgo",
+                        help="block hash algorithm (not sha256: creates BHL v3)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=("number of parallel processes"), metavar="n")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        default=False,
+                        help="skip unchanged files, hash only the growth of appended ones")
+    parser.add_argument("--tar", action="store_true", default=False,
+                        help="read tar archives as a stream, with a BHL for each member")
+    parser.add_argument("--tee", action="store_true", default=False,
+                        help="copy the streams read to stdout")
+    parser.add_argument("--name", action="store", default="stdin",
+                        help="file name for the data read from stdin",
+                        metavar="filename")
+    parser.add_argument("--stats", type=str, default="",
+                        help="write time spent & work done in each phase " +
+                        "to a JSON file", metavar="filename")
+    parser.add_argument("--profile", type=str, default="",
+                        help="write cProfile data to a file",
+                        metavar="filename")
     res = parser.parse_args()
     return res
 
@@ -65,71 +98,417 @@ def errexit(errlev=1, mess=""):
     sys.exit(errlev)
 
 
-def buildBHL(filename, bhlfilename, blocksize):
-    filesize = os.path.getsize(filename)
-    fin = open(filename, "rb", buffering=1024*1024)
-    print("creating file '%s'..." % bhlfilename)
-    open(bhlfilename, 'w').close()
-    fout = open(bhlfilename, "wb", buffering=1024*1024)
-
-    #write header
-    fout.write(b"BlockHashLoc\x1a")
-    fout.write(bytes([BHL_VER]))
-    fout.write(blocksize.to_bytes(4, byteorder='big', signed=False))
-    fout.write(filesize.to_bytes(8, byteorder='big', signed=False))
-
-    #write metadata
-    metadata = b""
-    bb = os.path.split(filename)[1].encode()
-    bb = b"FNM" + bytes([len(bb)]) + bb
-    metadata += bb
-    bb = int(os.path.getmtime(filename)).to_bytes(8, byteorder='big')
-    bb = b"FDT" + bytes([len(bb)]) + bb
-    metadata += bb
-
-    metadata = len(metadata).to_bytes(4, byteorder='big') + metadata
-    fout.write(metadata)
-
-    #read blocks and calc hashes
-    globalhash = hashlib.sha256()
-    blocksnum = 0
-    ticks = 0
-    updatetime = time() 
-    bufferz = b""
+class TeeReader():
+    """A stream that copies all the data read from another one to a third"""
+
+    def __init__(self, fin, fout):
+        self.fin = fin
+        self.fout = fout
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        self.fout.write(data)
+        return data
+
+    def readinto(self, buffer):
+        n = self.fin.readinto(buffer)
+        if n:
+            self.fout.write(memoryview(buffer)[:n])
+        return n
+
+    def Drain(self):
+        """Copy what's left of the stream"""
+        while self.read(CHUNK_SIZE):
+            pass
+        self.fout.flush()
+
+
+def readChunks(fin, chunksize, blocksize, bhlver, hashalgo="sha256"):
+    """Read a file a chunk at a time - yield hashBlocks results"""
     while True:
-        buffer = fin.read(blocksize)
-        if len(buffer) < blocksize:
-            if len(buffer) == 0:
-                break
+        buffer = fin.read(chunksize)
+        if not buffer:
+            break
+        yield hashBlocks(buffer, blocksize, bhlver, hashalgo)
+
+
+def hashJob(job):
+    """Hash the blocks of a file range in a worker process"""
+    filename, start, end, blocksize, bhlver, hashalgo = job
+    with open(filename, "rb") as fin:
+        fin.seek(start, 0)
+        buffer = fin.read(end - start)
+    return hashBlocks(buffer, blocksize, bhlver, hashalgo)
+
+
+def hashChunks(filename, fin, filesize, blocksize, bhlver, hashalgo,
+               pool=None, startpos=0):
+    """Hash a file from startpos a chunk at a time - yield hashBlocks
+    results, in order"""
+    chunksize = max(CHUNK_SIZE // blocksize, 1) * blocksize
+    if pool:
+        #chunks hashed in parallel, but collected in order
+        return pool.imap(hashJob,
+                         [(filename, start, min(start + chunksize, filesize),
+                           blocksize, bhlver, hashalgo)
+                          for start in range(startpos, filesize, chunksize)])
+    fin.seek(startpos)
+    return readChunks(fin, chunksize, blocksize, bhlver, hashalgo)
+
+
+def checkBHL(filename, bhlfilename, blocksize, bhlver, hashalgo="sha256"):
+    """Compare a file with its previous BHL file - return None if unchanged,
+    else how many blocks at the start have still the same hashes"""
+    try:
+        with BHLFile(bhlfilename) as bhlfile:
+            if bhlfile.catalog:
+                return 0
+            record = next(bhlfile.Records())
+            if (record.version != bhlver or record.blocksize != blocksize or
+                record.hashalgo != hashalgo):
+                return 0
+            filesize = os.path.getsize(filename)
+            oldsize = record.filesize
+            if (filesize == oldsize and record.metadata.get("filedatetime") ==
+                int(os.path.getmtime(filename))):
+                return None
+            if filesize <= oldsize:
+                return 0
+
+            #grown: assume an append if the old last block and remainder
+            #are there
+            oldblocks = oldsize // blocksize
+            with open(filename, "rb") as fin:
+                if oldblocks:
+                    fin.seek((oldblocks-1) * blocksize)
+                    blockhash = HASH_ALGOS[hashalgo]
+                    if (blockhash(fin.read(blocksize)).digest() !=
+                        record.Digest(oldblocks-1)):
+                        return 0
+                remainder = record.LastBlock()
+                if fin.read(len(remainder)) != remainder:
+                    return 0
+            return oldblocks
+    except (OSError, BHLError):
+        return 0
+
+
+def readEntries(bhlfilename, blocksnum):
+    """Read back the hashes of the first blocks from a BHL file - yield them
+    as hashBlocks results"""
+    with BHLFile(bhlfilename) as bhlfile:
+        record = next(bhlfile.Records())
+        for chunk in record.Entries(blocksnum, CHUNK_SIZE):
+            entries = bytes(chunk)
+            if record.version >= 2:
+                digests = b"".join([entries[p:p+32]
+                                    for p in range(0, len(entries), 36)])
+                weaks = b"".join([entries[p+32:p+36]
+                                  for p in range(0, len(entries), 36)])
             else:
-                #compressed blob with last block remainder
-                bufferz = zlib.compress(buffer, 9)
-        blockhash = hashlib.sha256()
-        blockhash.update(buffer)
-        digest = blockhash.digest()
-        globalhash.update(digest)
-        fout.write(digest)
-        blocksnum += 1
-
-        #some progress update
-        if time() > updatetime:
-            print("%.1f%%" % (fin.tell()*100.0/filesize), " ",
-                  end="\r", flush=True)
-            updatetime = time() + .1
-        
-    #write hash of hashes and block remainder (if present)
-    fout.write(globalhash.digest())
-    if len(bufferz):
-        fout.write(bufferz)
-    
-    fin.close()
-    fout.close()
+                digests = entries
+                weaks = b""
+            yield entries, digests, weaks
+
+
+def progressPrinter(stats=None):
+    """Progress callback printing the percentage done, from time to time
+    (and sampling the throughput, if stats are given)"""
+    updatetime = time()
+    def showProgress(donesize, filesize):
+        nonlocal updatetime
+        now = time()
+        if now > updatetime:
+            #the size of a stream is known only at its end
+            if filesize is None:
+                print("%.1fMB" % (donesize / (1024*1024)), " ",
+                      end="\r", flush=True)
+            else:
+                print("%.1f%%" % (donesize*100.0/filesize), " ",
+                      end="\r", flush=True)
+            updatetime = now + .1
+            if stats:
+                stats.Sample("hash", stats.counts.get("bytes read", 0) +
+                             donesize)
+    return showProgress
+
+
+def buildBHL(filename, bhlfilename, blocksize, bhlver=BHL_VER, verbose=True,
+             pool=None, incremental=False, hashalgo="sha256", stats=None):
+    """Create the BHL file of a file - return the BHL file size, the number
+    of blocks and the size ratio. Time spent and work done are added to
+    stats, if given."""
+    if not stats:
+        stats = Stats()
+    #with a previous BHL file, maybe there's nothing or little to do
+    oldblocks = 0
+    if incremental and os.path.exists(bhlfilename):
+        with stats.Phase("check", filename):
+            oldblocks = checkBHL(filename, bhlfilename, blocksize, bhlver,
+                                 hashalgo)
+        if oldblocks is None:
+            stats.Count("files unchanged")
+            if verbose:
+                print("file '%s' unchanged" % bhlfilename)
+            with BHLFile(bhlfilename) as bhlfile:
+                filesize = next(bhlfile.Records()).filesize
+            bhlfilesize = os.path.getsize(bhlfilename)
+            return (bhlfilesize, filesize // blocksize,
+                    bhlfilesize * 100 / max(filesize, 1))
+
+    filesize = os.path.getsize(filename)
+    fin = open(filename, "rb", buffering=1024*1024)
+    if verbose:
+        if oldblocks:
+            print("updating file '%s'..." % bhlfilename)
+        else:
+            print("creating file '%s'..." % bhlfilename)
+    #the previous version is read while the new one is written
+    outfilename = bhlfilename + ".tmp" if oldblocks else bhlfilename
+    open(outfilename, 'w').close()
+    fout = open(outfilename, "wb", buffering=1024*1024)
+
+    #the hashes of unchanged blocks come from the old BHL file, and the
+    #others from the pool workers if any: else the writer reads the file
+    chunks = None
+    if oldblocks or pool:
+        chunks = itertools.chain(
+            readEntries(bhlfilename, oldblocks) if oldblocks else (),
+            hashChunks(filename, fin, filesize, blocksize, bhlver, hashalgo,
+                       pool, oldblocks * blocksize))
+    writer = BHLWriter(fout, blocksize, bhlver, hashalgo)
+    with stats.Phase("hash", filename):
+        blocksnum = writer.AddFile(fin, filesize, os.path.split(filename)[1],
+                                   os.path.getmtime(filename), chunks=chunks,
+                                   progress=(progressPrinter(stats) if verbose
+                                             else None))[0]
+        writer.Close()
+
+        fin.close()
+        fout.close()
+    if oldblocks:
+        os.replace(outfilename, bhlfilename)
 
     #show stats about the file just created
     bhlfilesize = os.path.getsize(bhlfilename)
+    stats.Add({"files": 1, "bytes read": filesize - oldblocks * blocksize,
+               "blocks hashed": blocksnum - oldblocks,
+               "blocks reused": oldblocks, "bhl bytes written": bhlfilesize})
     overhead = bhlfilesize * 100 / filesize
-    print("  BHL file size: %i - blocks: %i - ratio: %.1f%%" %
-          (bhlfilesize, blocksnum, overhead))
+    if verbose:
+        print("  BHL file size: %i - blocks: %i - ratio: %.1f%%" %
+              (bhlfilesize, blocksnum, overhead))
+    return bhlfilesize, blocksnum, overhead
+
+
+def recordJob(job):
+    """Hash a file for a catalog in a worker process - return (job, record)
+    with record as (hashes, file size, blocks num, last block size) or None"""
+    filename, blocksize, bhlver, hashalgo = job[:4]
+    try:
+        fout = io.BytesIO()
+        filesize = os.path.getsize(filename)
+        with open(filename, "rb", buffering=1024*1024) as fin:
+            blocksnum, lastsize = writeHashes(fin, fout, filesize, blocksize,
+                                              bhlver, hashalgo)[:2]
+        return job, (fout.getvalue(), filesize, blocksnum, lastsize)
+    except Exception:
+        return job, None
+
+
+def buildCatalog(catfilename, filelist, blocksize, bhlver=BHL_VER, cont=False,
+                 jobs=1, hashalgo="sha256", stats=None):
+    """Create a BHL catalog for a list of (filename, path in the catalog) -
+    return the number of files added and of errors. Time spent and work done
+    are added to stats, if given."""
+    if not stats:
+        stats = Stats()
+    print("creating file '%s'..." % catfilename)
+    try:
+        open(catfilename, 'w').close()
+        fout = open(catfilename, "wb", buffering=1024*1024)
+    except OSError:
+        errexit(1, "can't create BHL catalog '%s'" % (catfilename))
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    writer = BHLWriter(fout, blocksize, bhlver, hashalgo, catalog=True)
+
+    errors = 0
+    totsize = sum([os.path.getsize(filename) for filename, filepath in filelist])
+    donesize = 0
+    updatetime = time()
+
+    def recordError(filename):
+        nonlocal errors
+        if not cont:
+            if pool:
+                pool.terminate()
+            print()
+            errexit(1, "can't add file '%s' to the BHL catalog" % (filename))
+        errors += 1
+        print("\n  warning: can't add file '%s'!" % filename)
+
+    def showProgress():
+        nonlocal updatetime
+        if (time() > updatetime or
+            writer.filesnum + errors == len(filelist)):
+            print("%.1f%% - files: %i/%i" %
+                  (donesize*100.0/max(totsize, 1), writer.filesnum + errors,
+                   len(filelist)), " ", end="\r", flush=True)
+            updatetime = time() + .1
+            stats.Sample("hash", donesize)
+
+    if pool:
+        #biggest files first: the ones bigger than a fair share of the work
+        #are split between all the workers, the others go one per worker
+        filelist = sorted(filelist, key=lambda f: os.path.getsize(f[0]),
+                          reverse=True)
+        bigsize = max(totsize // jobs, CHUNK_SIZE * 2)
+        bigfiles = [f for f in filelist if os.path.getsize(f[0]) > bigsize]
+        smallfiles = filelist[len(bigfiles):]
+    else:
+        bigfiles = filelist
+        smallfiles = []
+
+    for filename, filepath in bigfiles:
+        try:
+            filesize = os.path.getsize(filename)
+            with open(filename, "rb", buffering=1024*1024) as fin:
+                chunks = None
+                if pool:
+                    chunks = hashChunks(filename, fin, filesize, blocksize,
+                                        bhlver, hashalgo, pool)
+                with stats.Phase("hash", filename):
+                    writer.AddFile(fin, filesize, os.path.split(filename)[1],
+                                   os.path.getmtime(filename), filepath, chunks)
+            donesize += filesize
+        except Exception:
+            recordError(filename)
+        showProgress()
+
+    if smallfiles:
+        jobs = [(filename, blocksize, bhlver, hashalgo, filepath)
+                for filename, filepath in smallfiles]
+        #time spent waiting for the workers
+        with stats.Phase("hash"):
+            for job, record in pool.imap_unordered(recordJob, jobs):
+                filename, filepath = job[0], job[4]
+                if record:
+                    writer.AddRecord(record[0], *record[1:],
+                                     filename=os.path.split(filename)[1],
+                                     filedatetime=os.path.getmtime(filename),
+                                     filepath=filepath)
+                    donesize += record[1]
+                else:
+                    recordError(filename)
+                showProgress()
+    if pool:
+        pool.close()
+        pool.join()
+    print()
+
+    writer.Close()
+    fout.close()
+
+    #show stats about the file just created
+    catfilesize = os.path.getsize(catfilename)
+    stats.Add({"files": writer.filesnum, "bytes read": donesize,
+               "blocks hashed": writer.blocksnum,
+               "bhl bytes written": catfilesize})
+    print("  BHL catalog size: %i - files: %i - blocks: %i - ratio: %.1f%%" %
+          (catfilesize, writer.filesnum, writer.blocksnum,
+           catfilesize * 100 / max(totsize, 1)))
+    return writer.filesnum, errors
+
+
+def streamFiles(fin, tar=False, filename="", filedatetime=None):
+    """Read a stream in a single pass - yield (stream, file size or None,
+    file name, date & time, path) for itself, or for each regular member of
+    a tar archive"""
+    if not tar:
+        yield fin, None, filename, filedatetime, ""
+        return
+    with tarfile.open(fileobj=fin, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            #the members paths can't go outside of the destination path
+            memberpath = os.path.normpath(member.name.lstrip("/"))
+            if memberpath == ".." or memberpath.startswith(".." + os.sep):
+                print("  warning: skipping member '%s'!" % member.name)
+                continue
+            filepath, filename = os.path.split(memberpath)
+            yield (archive.extractfile(member), member.size, filename,
+                   member.mtime, filepath)
+
+
+def buildStream(fin, destpath, blocksize, bhlver=BHL_VER, tar=False,
+                filename="", filedatetime=None, hashalgo="sha256",
+                writer=None, cont=False, stats=None):
+    """Create the BHL files of a stream read in a single pass, of itself or
+    of each member of a tar archive, or add them to a catalog writer -
+    return the number of files done and of errors. Time spent and work done
+    are added to stats, if given."""
+    if not stats:
+        stats = Stats()
+    filesok = 0
+    errors = 0
+    for (fmember, filesize, filename, filedatetime,
+         filepath) in streamFiles(fin, tar, filename, filedatetime):
+        progress = progressPrinter(stats)
+        try:
+            if writer:
+                print("adding file '%s'..." % os.path.join(filepath, filename))
+                blocksnum = writer.blocksnum
+                datasize = writer.datasize
+                with stats.Phase("hash", filename):
+                    writer.AddFile(fmember, filesize, filename, filedatetime,
+                                   filepath, progress=progress)
+                stats.Add({"files": 1,
+                           "bytes read": writer.datasize - datasize,
+                           "blocks hashed": writer.blocksnum - blocksnum})
+            else:
+                bhlpath = os.path.join(destpath, filepath)
+                if bhlpath:
+                    os.makedirs(bhlpath, exist_ok=True)
+                bhlfilename = os.path.join(bhlpath, filename + ".bhl")
+                print("creating file '%s'..." % bhlfilename)
+                try:
+                    with open(bhlfilename, "wb",
+                              buffering=1024*1024) as fout:
+                        bhlwriter = BHLWriter(fout, blocksize, bhlver,
+                                              hashalgo)
+                        with stats.Phase("hash", filename):
+                            bhlwriter.AddFile(fmember, filesize, filename,
+                                              filedatetime, progress=progress)
+                except Exception:
+                    os.remove(bhlfilename)
+                    raise
+                bhlfilesize = os.path.getsize(bhlfilename)
+                stats.Add({"files": 1, "bytes read": bhlwriter.datasize,
+                           "blocks hashed": bhlwriter.blocksnum,
+                           "bhl bytes written": bhlfilesize})
+                print("  BHL file size: %i - blocks: %i - ratio: %.1f%%" %
+                      (bhlfilesize, bhlwriter.blocksnum,
+                       bhlfilesize * 100 / max(bhlwriter.datasize, 1)))
+            filesok += 1
+        except Exception:
+            if not cont:
+                print()
+                errexit(1, "can't index file '%s'" % filename)
+            errors += 1
+            print("\n  warning: can't index file '%s'!" % filename)
+    return filesok, errors
+
+
+def buildJob(job):
+    """Create a BHL file in a worker process - return (job, stats or None)"""
+    filename, bhlfilename, blocksize, bhlver, incremental, hashalgo = job
+    try:
+        return job, buildBHL(filename, bhlfilename, blocksize, bhlver,
+                             verbose=False, incremental=incremental,
+                             hashalgo=hashalgo)
+    except Exception:
+        return job, None
 
 
 def main():
@@ -137,24 +516,127 @@ def main():
     cmdline = get_cmdline()
     blocksize = cmdline.blocksize
 
-    #build list of files to process
+    #reports are written at exit, whatever the way
+    stats = Stats()
+    if cmdline.stats:
+        atexit.register(stats.Save, cmdline.stats, program="bhlmake",
+                        version=PROGRAM_VER, args=sys.argv[1:])
+    if cmdline.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(profiler.dump_stats, cmdline.profile)
+
+    #BHL v3 records the block hash algorithm
+    bhlver = cmdline.bhlver
+    if cmdline.hashalgo != "sha256":
+        if bhlver < 2:
+            errexit(1, "hash algorithm '%s' needs BHL v3" % cmdline.hashalgo)
+        bhlver = 3
+
+    #streams are read just once, in order, while (maybe) passed through
+    if cmdline.tee and not (cmdline.tar or "-" in cmdline.filename):
+        errexit(1, "--tee needs stdin ('-') or --tar")
+    if cmdline.tar or "-" in cmdline.filename:
+        if cmdline.incremental:
+            errexit(1, "incremental mode needs files, not streams")
+        teeout = None
+        if cmdline.tee:
+            #stdout is for the data, and the messages go to stderr
+            teeout = sys.stdout.buffer
+            sys.stdout = sys.stderr
+        destpath = cmdline.destpath
+        writer = None
+        if cmdline.catalog:
+            catfilename = cmdline.catalog
+            if destpath and os.path.isdir(destpath):
+                catfilename = os.path.join(destpath, catfilename)
+            print("creating file '%s'..." % catfilename)
+            try:
+                fcat = open(catfilename, "wb", buffering=1024*1024)
+            except OSError:
+                errexit(1, "can't create BHL catalog '%s'" % (catfilename))
+            writer = BHLWriter(fcat, blocksize, bhlver, cmdline.hashalgo,
+                               catalog=True)
+        bhlok = 0
+        bhlerr = 0
+        for filespec in cmdline.filename:
+            if filespec == "-":
+                fsource = sys.stdin.buffer
+                filename, filedatetime = cmdline.name, time()
+            else:
+                if not os.path.exists(filespec):
+                    errexit(1, "file '%s' not found" % (filespec))
+                fsource = open(filespec, "rb", buffering=1024*1024)
+                filename = os.path.split(filespec)[1]
+                filedatetime = os.path.getmtime(filespec)
+            fin = TeeReader(fsource, teeout) if teeout else fsource
+            filesok, errors = buildStream(fin, destpath, blocksize, bhlver,
+                                          cmdline.tar, filename, filedatetime,
+                                          cmdline.hashalgo, writer,
+                                          cmdline.cont, stats)
+            bhlok += filesok
+            bhlerr += errors
+            if teeout:
+                #a tar archive can have some padding after its end
+                fin.Drain()
+            if filespec != "-":
+                fsource.close()
+        if writer:
+            writer.Close()
+            fcat.close()
+            catfilesize = os.path.getsize(catfilename)
+            stats.Add({"bhl bytes written": catfilesize})
+            print("  BHL catalog size: %i - files: %i - blocks: %i - "
+                  "ratio: %.1f%%" %
+                  (catfilesize, writer.filesnum, writer.blocksnum,
+                   catfilesize * 100 / max(writer.datasize, 1)))
+        if bhlok + bhlerr > 1 or bhlerr:
+            print("\nfiles indexed: %i - errors: %i" % (bhlok, bhlerr))
+        return
+
+    #build list of files to process, with their path from the root dir
     filenames = []
-    for filespec in cmdline.filename:
-        filepath, filename = os.path.split(filespec)
-        if not filepath:
-            filepath = "."
-        if not filename:
-            filename = "*"
-        for wroot, wdirs, wfiles in os.walk(filepath):
-            if not cmdline.recurse:
-                wdirs[:] = []
-            for fn in fnmatch.filter(wfiles, filename):
-                filenames.append(os.path.join(wroot, fn))
-    filenames = sorted(set(filenames), key=os.path.getsize)
+    filepaths = {}
+    with stats.Phase("list files"):
+        for filespec in cmdline.filename:
+            filepath, filename = os.path.split(filespec)
+            if not filepath:
+                filepath = "."
+            if not filename:
+                filename = "*"
+            for wroot, wdirs, wfiles in os.walk(filepath):
+                if not cmdline.recurse:
+                    wdirs[:] = []
+                relpath = os.path.relpath(wroot, filepath)
+                for fn in fnmatch.filter(wfiles, filename):
+                    filenames.append(os.path.join(wroot, fn))
+                    filepaths[filenames[-1]] = "" if relpath == "." else relpath
+        filenames = sorted(set(filenames), key=os.path.getsize)
 
-    bhlok = 0
-    bhlerr = 0
+    #a whole tree goes in a single catalog
+    if cmdline.recurse or cmdline.catalog:
+        catfilename = cmdline.catalog
+        if not catfilename:
+            filepath = os.path.split(cmdline.filename[0])[0] or "."
+            catfilename = os.path.basename(os.path.abspath(filepath)) + ".bhl"
+        if cmdline.destpath and os.path.isdir(cmdline.destpath):
+            catfilename = os.path.join(cmdline.destpath, catfilename)
+        #don't include a previous version of the catalog itself
+        filenames = [filename for filename in filenames
+                     if os.path.abspath(filename) != os.path.abspath(catfilename)]
+        if not filenames:
+            errexit(1, "no files to process!")
+        bhlok, bhlerr = buildCatalog(catfilename,
+                                     [(filename, filepaths[filename])
+                                      for filename in filenames],
+                                     blocksize, bhlver, cmdline.cont,
+                                     cmdline.jobs, cmdline.hashalgo, stats)
+        if bhlerr > 0:
+            print("\nfiles added: %i - errors: %i" % (bhlok, bhlerr))
+        return
 
+    #pair each file with its BHL file name
+    jobs = []
     for filename in filenames:
         if not os.path.exists(filename):
             errexit(1, "file '%s' not found" % (filename))
@@ -167,9 +649,76 @@ def main():
                 destpath = os.path.split(filename)[0]
             bhlfilename = os.path.join(destpath,
                                        os.path.split(filename)[1] + ".bhl")
+        jobs.append((filename, bhlfilename, blocksize, bhlver,
+                     cmdline.incremental, cmdline.hashalgo))
+
+    bhlok = 0
+    bhlerr = 0
+
+    if cmdline.jobs > 1:
+        #biggest files first, so the pool drains evenly
+        jobs.reverse()
+        totsize = sum([os.path.getsize(job[0]) for job in jobs])
+        pool = multiprocessing.Pool(cmdline.jobs)
+
+        #files bigger than a fair share of the work are split between all
+        #the workers instead
+        bigsize = max(totsize // cmdline.jobs, CHUNK_SIZE * 2)
+        while jobs and os.path.getsize(jobs[0][0]) > bigsize:
+            (filename, bhlfilename, blocksize, bhlver, incremental,
+             hashalgo) = jobs.pop(0)
+            totsize -= os.path.getsize(filename)
+            try:
+                buildBHL(filename, bhlfilename, blocksize, bhlver, pool=pool,
+                         incremental=incremental, hashalgo=hashalgo,
+                         stats=stats)
+                bhlok += 1
+            except:
+                if cmdline.cont:
+                    bhlerr += 1
+                    print("  warning: can't create BHL file!")
+                else:
+                    pool.terminate()
+                    errexit(1, "can't creating BHL file '%s'" % (bhlfilename))
+
+        donesize = 0
+        updatetime = time()
+        #time spent waiting for the workers
+        with stats.Phase("hash"):
+            for job, result in pool.imap_unordered(buildJob, jobs):
+                filename, bhlfilename = job[:2]
+                if result:
+                    bhlok += 1
+                    stats.Add({"files": 1,
+                               "bytes read": os.path.getsize(filename),
+                               "blocks hashed": result[1],
+                               "bhl bytes written": result[0]})
+                elif cmdline.cont:
+                    bhlerr += 1
+                    print("\n  warning: can't create BHL file '%s'!" % bhlfilename)
+                else:
+                    pool.terminate()
+                    print()
+                    errexit(1, "can't creating BHL file '%s'" % (bhlfilename))
+                donesize += os.path.getsize(filename)
+                stats.Sample("hash", donesize)
+
+                #some progress update, for all the files together
+                if time() > updatetime or bhlok + bhlerr == len(filenames):
+                    print("%.1f%% - files: %i/%i" %
+                          (donesize*100.0/max(totsize, 1), bhlok + bhlerr,
+                           len(filenames)), " ", end="\r", flush=True)
+                    updatetime = time() + .1
+        pool.close()
+        pool.join()
+        print("\nBHL files created: %i - errors: %i" % (bhlok, bhlerr))
+        return
 
+    for (filename, bhlfilename, blocksize, bhlver, incremental,
+         hashalgo) in jobs:
         try:
-            buildBHL(filename, bhlfilename, blocksize)
+            buildBHL(filename, bhlfilename, blocksize, bhlver,
+                     incremental=incremental, hashalgo=hashalgo, stats=stats)
             bhlok += 1
         except:
             if cmdline.cont:
@@ -25,16 +25,28 @@
 
 import os
 import sys
+import errno
 import hashlib
 import argparse
 import time
 import zlib
 import sqlite3
 import glob
+import math
+import stat
+import multiprocessing
+import threading
+import queue
+import bisect
+import collections
+import atexit
+import cProfile
+from array import array
+
+from bhl import (BHLError, BHLFile, BHLRecord, BHL_VER, HASH_ALGOS, CHUNK_SIZE,
+                 Stats, fillBuffer, hashBlocks)
 
 PROGRAM_VER = "0.7.17b"
-BHL_VER = 1
-BHL_MAGIC = b"BlockHashLoc\x1a"
 
 def get_cmdline():
     """Evaluate command line parameters, usage & help."""
@@ -49,7 +61,8 @@ def get_cmdline():
                         help="image(s)/volumes(s) to scan")
     parser.add_argument("-db", "--database", action="store", dest="dbfilename",
                         metavar="filename",
-                        help="temporary db with recovery info",
+                        help=("temporary db with recovery info " +
+                              "(:memory:, :array: or a file name)"),
                         default=":memory:")
     parser.add_argument("-bhl", action="store", nargs="+", dest="bhlfilename", 
                         help="BHL file(s)", metavar="filename", required=True)
@@ -61,7 +74,44 @@ def get_cmdline():
                         help=("scan step"), metavar="n")
     parser.add_argument("-t","--test", action="store_true", default=False,
                         help="only test BHL file(s)")
+    parser.add_argument("-vf","--verify", action="store_true", default=False,
+                        help="verify the files against their BHL file(s) " +
+                        "(files are searched in -d path, or next to the " +
+                        "BHL files)")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="resume an interrupted scan from the -db file")
+    parser.add_argument("-ws", "--window", type=int, default=16,
+                        help=("scan window size, in MB"), metavar="n")
+    parser.add_argument("-sk", "--skipahead", action="store_true",
+                        default=False,
+                        help="after a block is found, continue from its end")
+    parser.add_argument("-wf", "--writefound", action="store_true",
+                        default=False,
+                        help="write the blocks to the files as they are found")
+    parser.add_argument("-ci", "--concurrent", action="store_true",
+                        default=False,
+                        help="scan the images on different devices at once")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=("number of parallel scan/verify processes"),
+                        metavar="n")
+    parser.add_argument("-fm", "--filtermem", type=int, default=256,
+                        help=("max memory for the hashes filter, in MB " +
+                              "(0 = disabled)"), metavar="n")
+    parser.add_argument("-wm", "--weakmem", type=int, default=64,
+                        help=("max memory for the weak checksums filter, " +
+                              "in MB (0 = disabled)"), metavar="n")
+    parser.add_argument("-fp", "--fprate", type=float, default=0.001,
+                        help=("hashes filter target false positive rate"),
+                        metavar="n")
+    parser.add_argument("--stats", type=str, default="",
+                        help="write time spent & work done in each phase " +
+                        "to a JSON file", metavar="filename")
+    parser.add_argument("--profile", type=str, default="",
+                        help="write cProfile data (main thread only) " +
+                        "to a file", metavar="filename")
     res = parser.parse_args()
+    if not 0 < res.fprate < 1:
+        parser.error("the false positive rate must be between 0 and 1")
     return res
 
 
@@ -89,57 +139,85 @@ def mcd(nums):
     return res if res > 0 else 1
 
 
-def metadataDecode(data):
-    """Decode metadata"""
-    metadata = {}
-    p = 0
-    while p < (len(data)-3):
-        metaid = data[p:p+3]
-        p+=3
-        metalen = data[p]
-        metabb = data[p+1:p+1+metalen]
-        p = p + 1 + metalen    
-        if metaid == b'FNM':
-            metadata["filename"] = metabb.decode('utf-8')
-        elif metaid == b'FDT':
-            metadata["filedatetime"] = int.from_bytes(metabb, byteorder='big')
-    return metadata
+def hashKey(digest):
+    """Compact integer DB key from a block hash"""
+    return int.from_bytes(digest[:8], byteorder='big', signed=True)
 
 
 class RecDB():
     """Helper class to access Sqlite3 DB with recovery info"""
 
     def __init__(self, dbfilename):
-        self.connection = sqlite3.connect(dbfilename)
+        #used by the concurrent scans too, always holding a lock
+        self.connection = sqlite3.connect(dbfilename, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        self.ondisk = dbfilename.upper() != ":MEMORY:"
+        if self.ondisk:
+            #loaded from the BHL files anyway: favor speed over durability
+            c = self.cursor
+            c.execute("PRAGMA page_size = 4096")
+            c.execute("PRAGMA journal_mode = WAL")
+            c.execute("PRAGMA synchronous = OFF")
+            c.execute("PRAGMA cache_size = -262144")
+            c.execute("PRAGMA temp_store = MEMORY")
 
     def Commit(self):
         self.connection.commit()
 
+    def ScanMode(self):
+        """From the scan on, commits have to survive an OS crash / power
+        loss too, to resume it (cheap enough, with WAL)"""
+        if self.ondisk:
+            self.connection.commit()
+            self.cursor.execute("PRAGMA synchronous = NORMAL")
+
     def CreateTables(self):
         c = self.cursor
-        c.execute("CREATE TABLE bhl_files (id INTEGER, blocksize INTEGER, size INTEGER, name TEXT, datetime INTEGER, lastblock BLOB, hash BLOB)")
-        c.execute("CREATE TABLE bhl_hashlist (hash BLOB, fileid INTEGER, sourceid INTEGER, num INTEGER, pos INTEGER)")
-        c.execute("CREATE INDEX hash ON bhl_hashlist (hash)")
+        c.execute("CREATE TABLE bhl_files (id INTEGER, blocksize INTEGER, size INTEGER, name TEXT, datetime INTEGER, lastblock BLOB, hash BLOB, version INTEGER, hashalgo TEXT)")
+        c.execute("CREATE TABLE bhl_hashlist (hkey INTEGER, hash BLOB, weak INTEGER, fileid INTEGER, sourceid INTEGER, num INTEGER, pos INTEGER)")
+        c.execute("CREATE TABLE scan_info (fingerprint BLOB, step INTEGER, offset INTEGER)")
+        c.execute("CREATE TABLE scan_images (id INTEGER, name TEXT, pos INTEGER)")
+        self.connection.commit()
+
+    def CreateIndex(self):
+        #built after the bulk load, much faster than updating it row by row
+        c = self.cursor
+        c.execute("CREATE INDEX hkey ON bhl_hashlist (hkey)")
+        #and to get each file's blocks, and info, at the rebuild
+        c.execute("CREATE INDEX hashlist_fileid ON bhl_hashlist (fileid, num)")
+        c.execute("CREATE INDEX files_id ON bhl_files (id)")
         self.connection.commit()
 
-    def SetFileData(self, fid=0, fblocksize=0, fsize=0, fname="", fdatetime=0, flastblock=b"", fhash=b""):
+    def SetFileData(self, fid=0, fblocksize=0, fsize=0, fname="", fdatetime=0, flastblock=b"", fhash=b"", fversion=BHL_VER, fhashalgo="sha256"):
         c = self.cursor
-        c.execute("INSERT INTO bhl_files (id, blocksize, size, name, datetime, lastblock, hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                  (fid, fblocksize, fsize, fname, fdatetime, flastblock, fhash))
+        c.execute("INSERT INTO bhl_files (id, blocksize, size, name, datetime, lastblock, hash, version, hashalgo) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  (fid, fblocksize, fsize, fname, fdatetime, flastblock, fhash, fversion, fhashalgo))
         self.connection.commit()
 
-    def AddHash(self, fhash=0, fid=0, fnum=0):
+    def AddHashes(self, hashlist):
+        """Bulk insert a list of (hkey, hash, weak, fileid, num)"""
         c = self.cursor
-        c.execute("INSERT INTO bhl_hashlist (hash, fileid, num) VALUES (?, ?, ?)",
-                  (fhash, fid, fnum))
+        c.executemany("INSERT INTO bhl_hashlist (hkey, hash, weak, fileid, num) VALUES (?, ?, ?, ?, ?)",
+                      hashlist)
 
     def SetHashPos(self, fhash=0, sid=0, pos=0):
         c = self.cursor
-        c.execute("UPDATE bhl_hashlist SET pos = ?, sourceid = ? WHERE hash = ? AND pos IS NULL",
-                  (pos, sid, fhash))
+        c.execute("UPDATE bhl_hashlist SET pos = ?, sourceid = ? WHERE hkey = ? AND hash = ? AND pos IS NULL",
+                  (pos, sid, hashKey(fhash), fhash))
         return c.rowcount
 
+    def GetHashBlocks(self, fhash):
+        """(fileid, num) of the blocks not found yet with a given hash"""
+        c = self.cursor
+        c.execute("SELECT fileid, num FROM bhl_hashlist WHERE hkey = ? AND hash = ? AND pos IS NULL",
+                  (hashKey(fhash), fhash))
+        return c.fetchall()
+
+    def GetFilesNum(self):
+        c = self.cursor
+        c.execute("SELECT COUNT(*) FROM bhl_files")
+        return c.fetchone()[0]
+
     def GetFileInfo(self, fid):
         c = self.cursor
         data = {}
@@ -152,14 +230,265 @@ class RecDB():
             data["filedatetime"] = res[4]
             data["lastblock"] = res[5]
             data["hash"] = res[6]
+            data["hashalgo"] = res[8]
         return data
 
     def GetWriteList(self, fid):
         c = self.cursor
         data = []
-        c.execute("SELECT num, sourceid, pos FROM bhl_hashlist WHERE fileid = %i AND pos IS NOT NULL ORDER BY num" % fid)
+        c.execute("SELECT num, sourceid, pos, hash FROM bhl_hashlist WHERE fileid = %i AND pos IS NOT NULL ORDER BY num" % fid)
+        return c.fetchall()
+
+    def SetScanInfo(self, fingerprint, step, offset):
+        c = self.cursor
+        c.execute("DELETE FROM scan_info")
+        c.execute("INSERT INTO scan_info (fingerprint, step, offset) VALUES (?, ?, ?)",
+                  (fingerprint, step, offset))
+        self.connection.commit()
+
+    def GetScanInfo(self):
+        c = self.cursor
+        data = {}
+        try:
+            c.execute("SELECT fingerprint, step, offset FROM scan_info")
+        except sqlite3.DatabaseError:
+            return data
+        res = c.fetchone()
+        if res:
+            data["fingerprint"] = res[0]
+            data["step"] = res[1]
+            data["offset"] = res[2]
+        return data
+
+    def SetImages(self, imgfilenames, pos):
+        c = self.cursor
+        c.execute("DELETE FROM scan_images")
+        c.executemany("INSERT INTO scan_images (id, name, pos) VALUES (?, ?, ?)",
+                      [(iid, imgfilenames[iid], pos)
+                       for iid in range(len(imgfilenames))])
+        self.connection.commit()
+
+    def GetImages(self):
+        c = self.cursor
+        c.execute("SELECT name, pos FROM scan_images ORDER BY id")
         return c.fetchall()
 
+    def SetImagePos(self, iid, pos):
+        c = self.cursor
+        c.execute("UPDATE scan_images SET pos = ? WHERE id = ?", (pos, iid))
+
+    def GetSizes(self):
+        """Blocks sizes, each with the lowest BHL version that use it and
+        its hash algorithm"""
+        c = self.cursor
+        c.execute("SELECT blocksize, MIN(version), MIN(hashalgo) FROM bhl_files GROUP BY blocksize")
+        return c.fetchall()
+
+    def GetBlocksNum(self):
+        c = self.cursor
+        c.execute("SELECT COUNT(*), COUNT(pos) FROM bhl_hashlist")
+        return c.fetchone()
+
+    def GetSizesLeft(self):
+        """Number of blocks not found yet, for each blocks size"""
+        c = self.cursor
+        c.execute("SELECT bhl_files.blocksize, COUNT(*) FROM bhl_hashlist JOIN bhl_files ON bhl_hashlist.fileid = bhl_files.id WHERE pos IS NULL GROUP BY bhl_files.blocksize")
+        return dict(c.fetchall())
+
+    def GetHashesLeft(self):
+        """Iterate on (hash, weak) of the blocks not found yet"""
+        c = self.connection.cursor()
+        c.execute("SELECT hash, weak FROM bhl_hashlist WHERE pos IS NULL")
+        return c
+
+
+class HashFilter():
+    """Bloom filter with the blocks hashes, to skip most of the DB lookups"""
+
+    def __init__(self, items, fprate=0.001, maxmem=256):
+        items = max(items, 1)
+        bits = int(-items * math.log(fprate) / (math.log(2) ** 2)) + 1
+        bits = min(bits, maxmem * 1024 * 1024 * 8)
+        self.bitsnum = max(bits, 64)
+        self.hashesnum = min(max(round(self.bitsnum / items * math.log(2)), 1), 16)
+        self.bits = bytearray((self.bitsnum + 7) // 8)
+
+    def Positions(self, digest):
+        #double hashing on two slices of the (already uniform) digest
+        h1 = int.from_bytes(digest[:8], byteorder='big')
+        h2 = int.from_bytes(digest[8:16], byteorder='big') | 1
+        return [(h1 + i * h2) % self.bitsnum for i in range(self.hashesnum)]
+
+    def Add(self, digest):
+        bits = self.bits
+        for p in self.Positions(digest):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def Check(self, digest):
+        #most misses stop at the first probe, so avoid computing them all
+        bits = self.bits
+        bitsnum = self.bitsnum
+        p = int.from_bytes(digest[:8], byteorder='big')
+        h2 = int.from_bytes(digest[8:16], byteorder='big') | 1
+        for i in range(self.hashesnum):
+            bp = p % bitsnum
+            if not bits[bp >> 3] & (1 << (bp & 7)):
+                return False
+            p += h2
+        return True
+
+
+class WeakFilter():
+    """Bitmap with the blocks weak checksums, to skip most of the strong hashes"""
+
+    def __init__(self, items, maxmem=64):
+        #about 16 bits per block, up to the whole 32 bits space or maxmem MB
+        maxbits = maxmem * 1024 * 1024 * 8
+        self.shift = 32
+        while (self.shift > 0 and (1 << (32 - self.shift)) < items * 16 and
+               (2 << (32 - self.shift)) <= maxbits):
+            self.shift -= 1
+        self.bits = bytearray(max((1 << (32 - self.shift)) // 8, 1))
+
+    def Add(self, weak):
+        p = ((weak * 2654435761) & 0xffffffff) >> self.shift
+        self.bits[p >> 3] |= 1 << (p & 7)
+
+    def Check(self, weak):
+        p = ((weak * 2654435761) & 0xffffffff) >> self.shift
+        return self.bits[p >> 3] & (1 << (p & 7))
+
+
+class ArrayDB():
+    """Array based alternative to RecDB, for hash lists that fit in RAM"""
+
+    #per block: 32 bytes hash, 4 file id, 8 block num, 4 source id, 8 pos,
+    #plus 2 hash table slots of 4 (or 8) bytes - 64 bytes in total, vs about
+    #78 bytes for an SQLite table row & index entry
+
+    def __init__(self):
+        self.files = {}
+        self.filerows = {}
+        self.hashes = bytearray()
+        self.fileids = array('I')
+        self.nums = array('Q')
+        self.sourceids = array('i')
+        self.positions = array('q')
+        self.slots = array('I')
+        self.mask = 0
+
+    def Commit(self):
+        pass
+
+    def ScanMode(self):
+        pass
+
+    def CreateTables(self):
+        pass
+
+    def CreateIndex(self):
+        #open addressing hash table with linear probing, at least half empty
+        rowsnum = len(self.fileids)
+        size = 8
+        while size < rowsnum * 2:
+            size <<= 1
+        self.mask = size - 1
+        slots = array('I' if rowsnum < 0xffffffff else 'Q')
+        slots.frombytes(bytes(size * slots.itemsize))
+        hashes = self.hashes
+        mask = self.mask
+        for row in range(rowsnum):
+            slot = int.from_bytes(hashes[row*32:row*32+8], byteorder='big') & mask
+            while slots[slot]:
+                slot = (slot + 1) & mask
+            slots[slot] = row + 1
+        self.slots = slots
+        self.sourceids = array('i', [-1]) * rowsnum
+        self.positions = array('q', [-1]) * rowsnum
+
+    def SetFileData(self, fid=0, fblocksize=0, fsize=0, fname="", fdatetime=0, flastblock=b"", fhash=b"", fversion=BHL_VER, fhashalgo="sha256"):
+        self.files[fid] = {"blocksize": fblocksize, "filesize": fsize,
+                           "filename": fname, "filedatetime": fdatetime,
+                           "lastblock": flastblock, "hash": fhash,
+                           "hashalgo": fhashalgo}
+
+    def AddHashes(self, hashlist):
+        """Bulk insert a list of (hkey, hash, weak, fileid, num)"""
+        for hkey, digest, weak, fid, num in hashlist:
+            if fid not in self.filerows:
+                self.filerows[fid] = [len(self.fileids), 0]
+            self.filerows[fid][1] = len(self.fileids) + 1
+            self.hashes += digest
+            self.fileids.append(fid)
+            self.nums.append(num)
+
+    def SetHashPos(self, fhash=0, sid=0, pos=0):
+        slots = self.slots
+        positions = self.positions
+        mask = self.mask
+        found = 0
+        slot = int.from_bytes(fhash[:8], byteorder='big') & mask
+        while slots[slot]:
+            row = slots[slot] - 1
+            if (positions[row] < 0 and
+                self.hashes[row*32:row*32+32] == fhash):
+                positions[row] = pos
+                self.sourceids[row] = sid
+                found += 1
+            slot = (slot + 1) & mask
+        return found
+
+    def GetHashBlocks(self, fhash):
+        slots = self.slots
+        mask = self.mask
+        data = []
+        slot = int.from_bytes(fhash[:8], byteorder='big') & mask
+        while slots[slot]:
+            row = slots[slot] - 1
+            if (self.positions[row] < 0 and
+                self.hashes[row*32:row*32+32] == fhash):
+                data.append((self.fileids[row], self.nums[row]))
+            slot = (slot + 1) & mask
+        return data
+
+    def GetFilesNum(self):
+        return len(self.files)
+
+    def GetFileInfo(self, fid):
+        return dict(self.files.get(fid, {}))
+
+    def GetWriteList(self, fid):
+        data = []
+        if fid in self.filerows:
+            start, end = self.filerows[fid]
+            for row in range(start, end):
+                if self.fileids[row] == fid and self.positions[row] >= 0:
+                    data.append((self.nums[row], self.sourceids[row],
+                                 self.positions[row],
+                                 bytes(self.hashes[row*32:row*32+32])))
+        data.sort()
+        return data
+
+    def GetSizesLeft(self):
+        sizes = {}
+        for fid, (start, end) in self.filerows.items():
+            blocksize = self.files[fid]["blocksize"]
+            for row in range(start, end):
+                if self.fileids[row] == fid and self.positions[row] < 0:
+                    sizes[blocksize] = sizes.get(blocksize, 0) + 1
+        return sizes
+
+    #nothing to keep for a resume, as all is lost with the process anyway
+
+    def SetScanInfo(self, fingerprint, step, offset):
+        pass
+
+    def SetImages(self, imgfilenames, pos):
+        pass
+
+    def SetImagePos(self, iid, pos):
+        pass
+
 
 def uniquifyFileName(filename):
     count = 0
@@ -172,6 +501,593 @@ def uniquifyFileName(filename):
     return filename
 
 
+def constRuns(view, datalen, minlen):
+    """Find the runs of a single byte value at least minlen long - return
+    them in order as (start, end, value)"""
+    runs = []
+    #a run that long contains at least a whole cell
+    cell = max(minlen // 2, 1)
+    cellsnum = datalen // cell
+    if not cellsnum:
+        return runs
+    #cells with the same first and last byte are the candidates: compared
+    #all at once, as big integers
+    firsts = view[0:cellsnum*cell:cell].tobytes()
+    lasts = view[cell-1:cellsnum*cell:cell].tobytes()
+    diff = (int.from_bytes(firsts, byteorder='big') ^
+            int.from_bytes(lasts, byteorder='big')).to_bytes(cellsnum,
+                                                             byteorder='big')
+    end = 0
+    i = diff.find(0)
+    while i >= 0:
+        q = i * cell
+        fill = firsts[i:i+1] * cell
+        if q >= end and view[q:q+cell].tobytes() == fill:
+            #extend the run both ways, a cell at a time and then to the byte
+            head = view[max(q - cell, end):q].tobytes()
+            start = q - (len(head) - len(head.rstrip(fill[:1])))
+            end = q + cell
+            while end + cell <= datalen and view[end:end+cell].tobytes() == fill:
+                end += cell
+            tail = view[end:min(end + cell, datalen)].tobytes()
+            end += len(tail) - len(tail.lstrip(fill[:1]))
+            if end - start >= minlen:
+                runs.append((start, end, fill[0]))
+            i = diff.find(0, -(-end // cell))
+        else:
+            i = diff.find(0, i + 1)
+    return runs
+
+
+def scanRanges(runs, size, endpos, scanstep):
+    """Scan positions for a block size, leaving out the ones of constant
+    blocks - return them as a list of ranges"""
+    ranges = []
+    p = 0
+    for start, end, value in runs:
+        first = -(-start // scanstep) * scanstep
+        last = end - size
+        if last < first:
+            continue
+        ranges.append(range(p, min(first, endpos), scanstep))
+        p = max(p, (last // scanstep + 1) * scanstep)
+    ranges.append(range(p, endpos, scanstep))
+    return ranges
+
+
+def scanBuffer(view, datalen, scanlen, basepos, scanstep, sizelist,
+               hashfilter, weakfilter, weaksizes, hashalgos, constblocks,
+               counts=None):
+    """Hash a buffer at every scan step - return probable hits as
+    (pos, size, digest, block), with block a view on the buffer.
+    Constant blocks aren't hashed: if wanted (their digests are in
+    constblocks as size: {value: digest}) only a hit per run is returned.
+    The hashes and weak checksums computed are added to counts, if given."""
+    hits = []
+    if not sizelist:
+        return hits
+    hashes = 0
+    weaks = 0
+
+    #constant runs (zeroed space, mostly) are found with plain compares
+    runs = constRuns(view, datalen, min(sizelist))
+    runstarts = [run[0] for run in runs]
+    for start, end, value in runs:
+        for size in sizelist:
+            digest = constblocks.get(size, {}).get(value)
+            p = -(-start // scanstep) * scanstep
+            if digest and p + size <= end and p < scanlen:
+                #any of the same blocks will do, for all of them
+                hits.append((basepos + p, size, digest, view[p:p+size]))
+
+    def check(p, size):
+        nonlocal hashes
+        hashes += 1
+        digest = HASH_ALGOS[hashalgos[size]](view[p:p+size]).digest()
+        #only go to the DB for probable hits
+        if not hashfilter or hashfilter.Check(digest):
+            hits.append((basepos + p, size, digest, view[p:p+size]))
+
+    #sizes without weak checksums are hashed all at once at each position:
+    #each longer block only adds its extra bytes to the shorter one's hash
+    #(if they use the same hash algorithm)
+    chained = []
+    for hashalgo in set([hashalgos[size] for size in sizelist]):
+        strongsizes = sorted([size for size in sizelist
+                              if not weaksizes[size] and
+                              hashalgos[size] == hashalgo])
+        if len(strongsizes) < 2:
+            continue
+        chained += strongsizes
+        endpos = min(scanlen, datalen - strongsizes[0] + 1)
+        for p in range(0, endpos, scanstep):
+            blockhash = HASH_ALGOS[hashalgo]()
+            hashedpos = p
+            i = bisect.bisect_right(runstarts, p) - 1
+            runend = runs[i][1] if i >= 0 else 0
+            for size in strongsizes:
+                if p + size > datalen:
+                    break
+                if p + size <= runend:
+                    #a constant block, already taken care of
+                    continue
+                blockhash.update(view[hashedpos:p+size])
+                hashedpos = p + size
+                #digest() doesn't finalize: the hash can go on from here
+                digest = blockhash.digest()
+                hashes += 1
+                if not hashfilter or hashfilter.Check(digest):
+                    hits.append((basepos + p, size, digest, view[p:p+size]))
+
+    #need to check for all sizes
+    for size in sizelist:
+        endpos = min(scanlen, datalen - size + 1)
+        if endpos <= 0:
+            continue
+        ranges = scanRanges(runs, size, endpos, scanstep)
+        if not weaksizes[size]:
+            if size in chained:
+                continue
+            for positions in ranges:
+                for p in positions:
+                    check(p, size)
+        elif scanstep * 1024 > size:
+            #strong hash only where the weak checksum match
+            for positions in ranges:
+                weaks += len(positions)
+                for p in positions:
+                    if weakfilter.Check(zlib.adler32(view[p:p+size])):
+                        check(p, size)
+        else:
+            #small steps on big blocks: cheaper to roll the weak checksum
+            for positions in ranges:
+                if not positions:
+                    continue
+                weaks += len(positions)
+                p = positions[0]
+                weak = zlib.adler32(view[p:p+size])
+                a = weak & 0xffff
+                b = weak >> 16
+                while True:
+                    if weakfilter.Check((b << 16) | a):
+                        check(p, size)
+                    nextp = p + scanstep
+                    if nextp >= positions.stop:
+                        break
+                    for q in range(p, nextp):
+                        xout = view[q]
+                        a = (a - xout + view[q + size]) % 65521
+                        b = (b - size * xout + a - 1) % 65521
+                    p = nextp
+    hits.sort(key=lambda hit: hit[:2])
+    if counts is not None:
+        counts["hashes"] = counts.get("hashes", 0) + hashes
+        counts["weak checksums"] = counts.get("weak checksums", 0) + weaks
+        counts["filter hits"] = counts.get("filter hits", 0) + len(hits)
+    return hits
+
+
+def scanBufferSkip(view, datalen, scanlen, basepos, scanstep, sizelist,
+                   hashfilter, weakfilter, weaksizes, hashalgos, constblocks,
+                   startp, lookup, counts=None):
+    """Like scanBuffer, but jumping to the end of each block found.
+    Probable hits go straight to lookup(pos, size, digest, block), that
+    return the number of blocks matched. Return the position where the scan ended."""
+    if not sizelist:
+        return max(startp, scanlen)
+    hashes = 0
+    weaks = 0
+    filterhits = 0
+    #rolling weak checksums state as size: (pos, a, b)
+    rolling = {}
+    runs = constRuns(view, datalen, min(sizelist))
+    runstarts = [run[0] for run in runs]
+    #constant blocks are looked up once per run, as (run, size)
+    constdone = set()
+    maxsize = max(sizelist)
+    p = startp
+    expected = 0
+    while p < scanlen:
+        #after a match, the next block of the same size is the likeliest
+        if expected:
+            sizes = [expected] + [size for size in sizelist if size != expected]
+        else:
+            sizes = sizelist
+        matched = 0
+        i = bisect.bisect_right(runstarts, p) - 1
+        runend, value = runs[i][1:] if i >= 0 else (0, 0)
+        #the hash of the last block checked at p, that a longer one can extend
+        blockhash = None
+        hashedsize = 0
+        for size in sizes:
+            if p + size > datalen:
+                continue
+            if p + size <= runend:
+                #a constant block: its digest is known, if wanted at all
+                digest = constblocks.get(size, {}).get(value)
+                if digest and (i, size) not in constdone:
+                    constdone.add((i, size))
+                    if (lookup(basepos + p, size, digest, view[p:p+size]) and
+                        not matched):
+                        matched = size
+                        if matched == expected:
+                            break
+                continue
+            if weaksizes[size]:
+                weaks += 1
+                #strong hash only where the weak checksum match
+                if scanstep * 1024 > size:
+                    weak = zlib.adler32(view[p:p+size])
+                else:
+                    #small steps on big blocks: cheaper to roll it
+                    if size in rolling and rolling[size][0] == p - scanstep:
+                        a, b = rolling[size][1:]
+                        for q in range(p - scanstep, p):
+                            xout = view[q]
+                            a = (a - xout + view[q + size]) % 65521
+                            b = (b - size * xout + a - 1) % 65521
+                    else:
+                        weak = zlib.adler32(view[p:p+size])
+                        a = weak & 0xffff
+                        b = weak >> 16
+                    rolling[size] = (p, a, b)
+                    weak = (b << 16) | a
+                if not weakfilter.Check(weak):
+                    continue
+            if (blockhash and hashedsize <= size and
+                hashalgos[size] == hashalgos[hashedsize]):
+                blockhash.update(view[p+hashedsize:p+size])
+            else:
+                blockhash = HASH_ALGOS[hashalgos[size]](view[p:p+size])
+            hashedsize = size
+            digest = blockhash.digest()
+            hashes += 1
+            #only go to the DB for probable hits
+            if hashfilter and not hashfilter.Check(digest):
+                continue
+            filterhits += 1
+            if lookup(basepos + p, size, digest, view[p:p+size]) and not matched:
+                matched = size
+                #the predicted block is there: no need to check other sizes
+                if matched == expected:
+                    break
+        if matched:
+            #the data up to the end of the block is known: jump there
+            p += matched
+            expected = matched
+        elif p + maxsize <= runend:
+            #all the blocks here are constant: jump where the biggest isn't
+            p = max(p + scanstep,
+                    p + -(-(runend - maxsize + 1 - p) // scanstep) * scanstep)
+            expected = 0
+        else:
+            p += scanstep
+            expected = 0
+    if counts is not None:
+        counts["hashes"] = counts.get("hashes", 0) + hashes
+        counts["weak checksums"] = counts.get("weak checksums", 0) + weaks
+        counts["filter hits"] = counts.get("filter hits", 0) + filterhits
+    return p
+
+
+def queueGet(q, stop):
+    """Get from a queue, unless the pipeline is stopped - None if so"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def queuePut(q, item, stop):
+    """Put in a queue, unless the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=.1)
+            return
+        except queue.Full:
+            pass
+
+
+def readWindows(fin, offset, windowsize, freeq, readq, stop, counts):
+    """Read-ahead stage: fill the free buffers with the windows in sequence,
+    each with the tail needed by the blocks that start near its end"""
+    try:
+        winpos = offset
+        while True:
+            view = queueGet(freeq, stop)
+            if view is None:
+                return
+            fin.seek(winpos, 0)
+            datalen = fillBuffer(fin, view)
+            counts["seeks"] = counts.get("seeks", 0) + 1
+            counts["bytes read"] = counts.get("bytes read", 0) + datalen
+            if datalen == 0:
+                break
+            queuePut(readq, (winpos, view, datalen), stop)
+            if datalen <= windowsize:
+                break
+            winpos += windowsize
+        queuePut(readq, None, stop)
+    except Exception as e:
+        queuePut(readq, e, stop)
+
+
+def hashWindows(windowsize, scanstep, sizelist, hashfilter, weakfilter,
+                weaksizes, hashalgos, constblocks, readq, hitq, stop, counts):
+    """Hashing stage: scan the windows read for probable hits"""
+    try:
+        while True:
+            item = queueGet(readq, stop)
+            if item is None or isinstance(item, Exception):
+                queuePut(hitq, item, stop)
+                return
+            winpos, view, datalen = item
+            scanlen = min(windowsize, datalen)
+            #sizes can be dropped meanwhile: use the ones at the window start
+            hits = scanBuffer(view, datalen, scanlen, winpos, scanstep,
+                              list(sizelist), hashfilter, weakfilter,
+                              weaksizes, hashalgos, constblocks, counts)
+            queuePut(hitq, (winpos, scanlen, hits, view), stop)
+    except Exception as e:
+        queuePut(hitq, e, stop)
+
+
+def scanWindows(imgfilename, offset, windowsize, scanstep, sizelist,
+                maxblocksize, hashfilter, weakfilter, weaksizes, hashalgos,
+                constblocks, lookup=None, buffersnum=4, counts=None):
+    """Scan a file sequentially a window at a time - yield (pos, len, hits).
+    With a lookup function, do the skip-ahead scan (hits are sent to it).
+    Reading and hashing run in their own threads, a few windows ahead.
+    Bytes read, seeks, hashes, etc. are added to counts, if given."""
+    if counts is None:
+        counts = {}
+    fin = open(imgfilename, "rb", buffering=0)
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fin.fileno(), offset, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+    #a fixed set of buffers goes around the stages: when all are in use,
+    #the read-ahead waits
+    freeq = queue.Queue()
+    for i in range(buffersnum):
+        freeq.put(memoryview(bytearray(windowsize + maxblocksize)))
+    readq = queue.Queue(buffersnum)
+    hitq = queue.Queue(buffersnum)
+    stop = threading.Event()
+    threads = [threading.Thread(target=readWindows,
+                                args=(fin, offset, windowsize, freeq, readq,
+                                      stop, counts))]
+    #lookups use the DB, that stays in this thread: with the skip-ahead
+    #scan, hashing has to be done here too
+    if not lookup:
+        threads.append(threading.Thread(target=hashWindows,
+                                        args=(windowsize, scanstep, sizelist,
+                                              hashfilter, weakfilter,
+                                              weaksizes, hashalgos,
+                                              constblocks, readq, hitq,
+                                              stop, counts)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    startp = 0
+    try:
+        while True:
+            item = queueGet(hitq if not lookup else readq, stop)
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if lookup:
+                winpos, view, datalen = item
+                scanlen = min(windowsize, datalen)
+                hits = []
+                endp = scanBufferSkip(view, datalen, scanlen, winpos, scanstep,
+                                      list(sizelist), hashfilter, weakfilter,
+                                      weaksizes, hashalgos, constblocks,
+                                      startp, lookup, counts)
+                #a skip-ahead can continue in the next window
+                startp = endp - windowsize
+            else:
+                winpos, scanlen, hits, view = item
+            yield winpos, scanlen, hits
+            #the hits are done with, and the buffer can be reused
+            freeq.put(view)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        fin.close()
+
+
+#scan parameters for the worker processes
+scanjob = {}
+
+def scanJobInit(params):
+    """Setup a scan worker process"""
+    scanjob.update(params)
+
+
+def scanJob(job):
+    """Scan a range of an image in a worker process - return (pos, len, hits,
+    counts)"""
+    imgfilename, start, end = job
+    view = memoryview(bytearray(end - start + scanjob["maxblocksize"]))
+    with open(imgfilename, "rb", buffering=0) as fin:
+        fin.seek(start, 0)
+        datalen = fillBuffer(fin, view)
+    scanlen = min(end - start, datalen)
+    counts = {"seeks": 1, "bytes read": datalen}
+    hits = scanBuffer(view, datalen, scanlen, start, scanjob["scanstep"],
+                      scanjob["sizelist"], scanjob["hashfilter"],
+                      scanjob["weakfilter"], scanjob["weaksizes"],
+                      scanjob["hashalgos"], scanjob["constblocks"], counts)
+    #views can't go back to the main process: send the blocks data only if
+    #they are needed there
+    if scanjob["writefound"]:
+        hits = [(pos, size, digest, bytes(block))
+                for pos, size, digest, block in hits]
+    else:
+        hits = [(pos, size, digest, None) for pos, size, digest, block in hits]
+    return start, scanlen, hits, counts
+
+
+def writeData(fdout, pos, data):
+    """Write data at a given position of a file"""
+    if hasattr(os, "pwrite"):
+        os.pwrite(fdout, data, pos)
+    else:
+        os.lseek(fdout, pos, os.SEEK_SET)
+        os.write(fdout, data)
+
+
+def readData(fdin, pos, size):
+    """Read data from a given position of a file"""
+    if hasattr(os, "pread"):
+        return os.pread(fdin, size, pos)
+    os.lseek(fdin, pos, os.SEEK_SET)
+    return os.read(fdin, size)
+
+
+def copyBlocks(fdin, fdout, srcpos, dstpos, size):
+    """Copy a run of data from an image to a file being rebuilt - return the
+    bytes copied (less than size if the image ends before)"""
+    copied = 0
+    #in kernel if possible, but not all the sources support it
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                n = os.copy_file_range(fdin, fdout, size - copied,
+                                       srcpos + copied, dstpos + copied)
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+    while copied < size:
+        buffer = readData(fdin, srcpos + copied,
+                          min(size - copied, 16*1024*1024))
+        if not buffer:
+            break
+        writeData(fdout, dstpos + copied, buffer)
+        copied += len(buffer)
+    return copied
+
+
+def createFile(filename, truncate=True):
+    """Open a file to rebuild - return its descriptor"""
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    #read back too, to check it
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if truncate:
+        flags |= os.O_TRUNC
+    return os.open(filename, flags, 0o666)
+
+
+def copyFoundBlocks(fdout, blocksize, writelist, fdlist, counts=None):
+    """Copy the blocks found from the images to a file - return the bytes
+    copied. writelist is a list of (num, sourceid, pos, hash). The copies
+    (each a seek on the source) and bytes copied are added to counts, if
+    given."""
+    #read in source order, merging contiguous blocks in single copies
+    run = None
+    copies = 0
+    copied = 0
+    for blocknum, imgid, pos, digest in sorted(writelist,
+                                               key=lambda d: (d[1], d[2])):
+        if (run and imgid == run[0] and pos == run[1] + run[3] and
+            blocknum * blocksize == run[2] + run[3]):
+            run[3] += blocksize
+            continue
+        if run:
+            copied += copyBlocks(fdlist[run[0]], fdout, run[1], run[2],
+                                 run[3])
+            copies += 1
+        run = [imgid, pos, blocknum * blocksize, blocksize]
+    if run:
+        copied += copyBlocks(fdlist[run[0]], fdout, run[1], run[2], run[3])
+        copies += 1
+    if counts is not None:
+        counts["copies"] = counts.get("copies", 0) + copies
+        counts["bytes copied"] = counts.get("bytes copied", 0) + copied
+    return copied
+
+
+def finishFile(fdout, fileinfo, writelist):
+    """Add the last block to a file with all the blocks found written -
+    return the hash of its hashes, computed on what's read back from it.
+    writelist is ordered by num."""
+    filesize = fileinfo["filesize"]
+    blocksize = fileinfo["blocksize"]
+    lastblock = fileinfo["lastblock"]
+    hashalgo = fileinfo.get("hashalgo") or "sha256"
+    if lastblock:
+        writeData(fdout, filesize - len(lastblock), lastblock)
+    #blocks not found are left as holes
+    os.ftruncate(fdout, filesize)
+
+    #rehash the blocks written, reading the consecutive ones together
+    filehash = HASH_ALGOS[hashalgo]()
+    chunkblocks = max(CHUNK_SIZE // blocksize, 1)
+    start = count = 0
+    for num in [data[0] for data in writelist] + [None]:
+        if count and num == start + count and count < chunkblocks:
+            count += 1
+            continue
+        if count:
+            buffer = readData(fdout, start * blocksize, count * blocksize)
+            filehash.update(hashBlocks(buffer, blocksize, 1, hashalgo)[1])
+        start, count = num, 1
+    if lastblock:
+        buffer = readData(fdout, filesize - len(lastblock), len(lastblock))
+        filehash.update(HASH_ALGOS[hashalgo](buffer).digest())
+    return filehash.digest()
+
+
+def rebuildFile(filename, fileinfo, writelist, fdlist, counts=None):
+    """Write the blocks found to a file - return the hash of its hashes and
+    the bytes copied. writelist is a list of (num, sourceid, pos, hash)
+    ordered by num."""
+    fdout = createFile(filename)
+    try:
+        copied = copyFoundBlocks(fdout, fileinfo["blocksize"], writelist,
+                                 fdlist, counts)
+        return finishFile(fdout, fileinfo, writelist), copied
+    finally:
+        os.close(fdout)
+
+
+def deviceId(filename):
+    """Id of the disk that holds a file or volume - where possible"""
+    st = os.stat(filename)
+    dev = st.st_rdev if stat.S_ISBLK(st.st_mode) else st.st_dev
+    if not hasattr(os, "major"):
+        return dev
+    #partitions of the same disk are on the same spindle
+    syspath = "/sys/dev/block/%i:%i" % (os.major(dev), os.minor(dev))
+    if not os.path.exists(syspath):
+        return dev
+    syspath = os.path.realpath(syspath)
+    if os.path.exists(os.path.join(syspath, "partition")):
+        syspath = os.path.dirname(syspath)
+    return os.path.basename(syspath)
+
+
+def constDigests(blocksize, hashalgo):
+    """Digests of the blocks of a single byte value - as digest: value"""
+    blockhash = HASH_ALGOS[hashalgo]
+    return {blockhash(bytes([value]) * blocksize).digest(): value
+            for value in range(256)}
+
+
 def getFileSize(filename):
     """Calc file size - works on devices too"""
     ftemp = os.open(filename, os.O_RDONLY)
@@ -181,15 +1097,696 @@ def getFileSize(filename):
         os.close(ftemp)
 
 
+def bhlFingerprint(bhlfilenames):
+    """Fingerprint of a set of BHL files, from headers and hashes of hashes"""
+    fingerprint = hashlib.sha256()
+    for filename in bhlfilenames:
+        with BHLFile(filename) as bhlfile:
+            fingerprint.update(bhlfile.Fingerprint())
+    return fingerprint.digest()
+
+
+def testBHL(bhlfilename, progress=None):
+    """Check all the hashes in a BHL file or catalog - raise BHLError if
+    something is corrupt. See BHLRecord.Digests for progress."""
+    with BHLFile(bhlfilename) as bhlfile:
+        for record in bhlfile.Records():
+            for num, digest, weak in record.Digests(progress):
+                pass
+            record.LastBlock()
+
+
+def verifyList(bhlfilenames, path=""):
+    """List the files to verify, as jobs for verifyJob - the files are
+    searched in path if given, else next to their BHL file"""
+    jobs = []
+    for bhlfilename in bhlfilenames:
+        with BHLFile(bhlfilename) as bhlfile:
+            for record in bhlfile.Records():
+                filename = record.filename
+                if not filename:
+                    filename = os.path.splitext(os.path.basename(bhlfilename))[0]
+                filename = os.path.join(path or os.path.dirname(bhlfilename),
+                                        filename)
+                jobs.append((bhlfilename, filename, record.filesize,
+                             record.blocksize, record.metadata,
+                             record.hashespos, record.lastsize))
+    return jobs
+
+
+def verifyJob(job, progress=None):
+    """Compare a file with the block hashes of its BHL record - return (job,
+    size of the file or None if not found, damaged blocks ranges, error or
+    None). See BHLRecord.Verify for progress."""
+    (bhlfilename, filename, filesize, blocksize, metadata, hashespos,
+     lastsize) = job
+    if not os.path.isfile(filename):
+        return job, None, [], None
+    try:
+        with BHLFile(bhlfilename) as bhlfile:
+            record = BHLRecord(bhlfile, filesize, metadata, hashespos,
+                               lastsize)
+            with open(filename, "rb", buffering=0) as fin:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fin.fileno(), 0, 0,
+                                     os.POSIX_FADV_SEQUENTIAL)
+                return (job, os.fstat(fin.fileno()).st_size,
+                        record.Verify(fin, progress), None)
+    except (OSError, BHLError) as e:
+        return job, None, [], str(e)
+
+
+class Recovery():
+    """Recover files from images/volumes, searching the blocks with the
+    hashes of a set of BHL files:
+
+        rec = Recovery(bhlfilenames)
+        for bhlfilename in bhlfilenames:
+            rec.AddBHL(bhlfilename)
+        rec.StartScan(imgfilenames)
+        for fileid, blocknum, sourceid, pos in rec.Scan():
+            ...
+        rec.Rebuild(destpath)
+        rec.Close()
+
+    Time spent and work done in each phase are recorded in rec.stats.
+    """
+
+    def __init__(self, bhlfilenames, dbfilename=":memory:", filtermem=256,
+                 fprate=0.001, resume=False, stats=None, weakmem=64):
+        if not 0 < fprate < 1:
+            raise BHLError("the false positive rate must be between 0 and 1")
+        self.bhlfilenames = bhlfilenames
+        self.resume = resume
+        self.stats = stats if stats else Stats()
+        self.globalblocksnum = 0
+        self.blocksfound = 0
+        self.filesnum = 0
+        self.sizelist = []
+        self.weaksizes = {}
+        self.hashalgos = {}
+        #digests of the constant blocks, and the ones in the BHL files, as
+        #size: {digest: value} and size: {value: digest}
+        self.constdigests = {}
+        self.constblocks = {}
+        self.hashfilter = None
+        #created with the first BHL with weak checksums
+        self.weakfilter = None
+        self.weakmem = weakmem
+        self.pool = None
+        self.fdlist = {}
+        self.stop = threading.Event()
+        #files written as their blocks are found: fid -> [fileinfo, filename,
+        #blocks left], the open ones as fid -> descriptor, and the hash of
+        #hashes of the ones already completed
+        self.writefound = False
+        self.outfiles = {}
+        self.outfds = {}
+        self.filesdone = {}
+        #bytes of the blocks found that couldn't be read back from the images
+        self.unreadable = {}
+        #DB and found blocks state are shared by the concurrent scans
+        self.lock = threading.RLock()
+
+        if resume:
+            if dbfilename.upper() in [":MEMORY:", ":ARRAY:"]:
+                raise BHLError("can't resume without a DB file!")
+            if not os.path.exists(dbfilename):
+                raise BHLError("DB file '%s' not found" % (dbfilename))
+            self.db = RecDB(dbfilename)
+            self.scaninfo = self.db.GetScanInfo()
+            if not self.scaninfo:
+                raise BHLError("no scan to resume in '%s'" % (dbfilename))
+            if self.scaninfo["fingerprint"] != bhlFingerprint(bhlfilenames):
+                raise BHLError("BHL files don't match the ones of the scan to resume!")
+
+            #restore the state needed by the scan, without reading the BHL
+            #files
+            with self.stats.Phase("db load"):
+                self.restoreState(filtermem, fprate)
+            return
+
+        if dbfilename.upper() == ":ARRAY:":
+            self.db = ArrayDB()
+        else:
+            if dbfilename.upper() != ":MEMORY:":
+                open(dbfilename, 'w').close()
+                #leftovers from a crashed run would be applied to the new DB
+                for filename in [dbfilename + "-wal", dbfilename + "-shm"]:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+            self.db = RecDB(dbfilename)
+        self.db.CreateTables()
+
+        #size the hashes filter on the upper bound of blocks in the BHL files
+        if filtermem > 0:
+            maxblocks = sum([os.path.getsize(filename) // 32
+                             for filename in bhlfilenames])
+            self.hashfilter = HashFilter(maxblocks, fprate=fprate,
+                                         maxmem=filtermem)
+        self.weakitems = sum([os.path.getsize(filename) // 36
+                              for filename in bhlfilenames])
+
+    def restoreState(self, filtermem, fprate):
+        """Restore the scan state from the DB, to resume it"""
+        for blocksize, bhlver, hashalgo in self.db.GetSizes():
+            self.sizelist.append(blocksize)
+            self.weaksizes[blocksize] = bhlver >= 2 and self.weakmem > 0
+            self.hashalgos[blocksize] = hashalgo or "sha256"
+            self.constdigests[blocksize] = constDigests(
+                blocksize, self.hashalgos[blocksize])
+        self.globalblocksnum, self.blocksfound = self.db.GetBlocksNum()
+        self.filesnum = self.db.GetFilesNum()
+        blocksleft = self.globalblocksnum - self.blocksfound
+        if filtermem > 0:
+            self.hashfilter = HashFilter(blocksleft, fprate=fprate,
+                                         maxmem=filtermem)
+        if any(self.weaksizes.values()):
+            self.weakfilter = WeakFilter(blocksleft, self.weakmem)
+        for digest, weak in self.db.GetHashesLeft():
+            if self.hashfilter:
+                self.hashfilter.Add(digest)
+            if weak is not None and self.weakfilter:
+                self.weakfilter.Add(weak)
+            for blocksize in self.constdigests:
+                if digest in self.constdigests[blocksize]:
+                    value = self.constdigests[blocksize][digest]
+                    self.constblocks.setdefault(blocksize, {})[value] = digest
+
+    def AddBHL(self, bhlfilename, progress=None):
+        """Read the hashes of a BHL file or catalog in the DB - raise BHLError
+        if it's corrupt. See BHLRecord.Digests for progress."""
+        db = self.db
+        hashfilter = self.hashfilter
+        stats = self.stats
+        with stats.Phase("bhl parse", bhlfilename):
+            with BHLFile(bhlfilename) as bhlfile:
+                for record in bhlfile.Records():
+                    blocksize = record.blocksize
+                    if not blocksize in self.sizelist:
+                        self.sizelist.append(blocksize)
+                    #weak checksums can be used only if present for all the blocks
+                    self.weaksizes[blocksize] = (self.weaksizes.get(blocksize, True)
+                                                 and record.version >= 2
+                                                 and self.weakmem > 0)
+                    if self.weaksizes[blocksize] and not self.weakfilter:
+                        self.weakfilter = WeakFilter(self.weakitems,
+                                                     self.weakmem)
+                    weakfilter = self.weakfilter
+                    #the scan computes a single hash for each block size
+                    if (self.hashalgos.setdefault(blocksize, record.hashalgo) !=
+                        record.hashalgo):
+                        raise BHLError("blocks of %i bytes with different hash algorithms!"
+                                       % blocksize)
+                    if blocksize not in self.constdigests:
+                        self.constdigests[blocksize] = constDigests(
+                            blocksize, record.hashalgo)
+                    sizeconsts = self.constdigests[blocksize]
+
+                    #read the block hashes a chunk at a time, straight to the DB
+                    #(the last block is kept apart)
+                    fid = self.filesnum
+                    blocksnum = record.filesize // blocksize
+                    hashlist = []
+                    for num, digest, weak in record.Digests(progress):
+                        if num >= blocksnum:
+                            continue
+                        hashlist.append((hashKey(digest), digest, weak, fid, num))
+                        if hashfilter:
+                            hashfilter.Add(digest)
+                        if weak is not None and weakfilter:
+                            weakfilter.Add(weak)
+                        if digest in sizeconsts:
+                            self.constblocks.setdefault(blocksize, {})[
+                                sizeconsts[digest]] = digest
+                        if len(hashlist) >= 100000:
+                            with stats.Phase("db load"):
+                                db.AddHashes(hashlist)
+                            hashlist = []
+                    lastblock = record.LastBlock()
+                    with stats.Phase("db load"):
+                        if hashlist:
+                            db.AddHashes(hashlist)
+                        db.SetFileData(fid=fid, fblocksize=blocksize,
+                                       fsize=record.filesize,
+                                       fname=record.filename,
+                                       fdatetime=record.metadata.get("filedatetime"),
+                                       flastblock=lastblock,
+                                       fhash=record.Hash(),
+                                       fversion=record.version,
+                                       fhashalgo=record.hashalgo)
+                    stats.Count("hashes loaded", blocksnum)
+                    self.globalblocksnum += blocksnum
+                    self.filesnum += 1
+            stats.Count("bhl bytes read", bhlfile.size)
+
+    def StartScan(self, imgfilenames=(), step=0, offset=0, window=16, jobs=1,
+                  skipahead=False, writefound=False, destpath=""):
+        """Get ready to scan a list of images/volumes (the ones of the scan
+        to resume, if so) from offset, with a given step (0 = auto). When
+        resuming, the images, step and offset given (if any) have to be the
+        ones of the scan."""
+        db = self.db
+        if not self.resume:
+            with self.stats.Phase("db index"):
+                db.CreateIndex()
+        db.ScanMode()
+        #the weak checksums of a size can be dropped by a BHL v1 added later
+        if not any(self.weaksizes.values()):
+            self.weakfilter = None
+
+        #select an adequate scan step
+        self.maxblocksize = max(self.sizelist)
+        if self.resume:
+            self.scanstep = self.scaninfo["step"]
+            self.offset = self.scaninfo["offset"]
+            if step and step != self.scanstep:
+                raise BHLError("the scan to resume has step %i, not %i!" %
+                               (self.scanstep, step))
+            if offset and offset != self.offset:
+                raise BHLError("the scan to resume has offset %i, not %i!" %
+                               (self.offset, offset))
+        else:
+            self.scanstep = step if step else mcd(self.sizelist)
+            self.offset = offset
+
+        #sizes are dropped from the scan as soon as all their blocks are found
+        self.sizelist.sort()
+        self.sizesleft = db.GetSizesLeft()
+        self.sizelist[:] = [size for size in self.sizelist
+                            if self.sizesleft.get(size, 0)]
+
+        #list of image files to process, with the scan start positions
+        if self.resume:
+            imglist = db.GetImages()
+            self.imgfilenames = [imgfilename for imgfilename, pos in imglist]
+            self.imgstartpos = [pos for imgfilename, pos in imglist]
+            if imgfilenames and (sorted(map(os.path.abspath, imgfilenames)) !=
+                                 sorted(map(os.path.abspath,
+                                            self.imgfilenames))):
+                raise BHLError("images don't match the ones of the scan to resume!")
+        else:
+            self.imgfilenames = list(imgfilenames)
+            self.imgstartpos = [offset] * len(self.imgfilenames)
+            #save what's needed to resume the scan
+            db.SetScanInfo(bhlFingerprint(self.bhlfilenames), self.scanstep,
+                           offset)
+            db.SetImages(self.imgfilenames, offset)
+        for imgfilename in self.imgfilenames:
+            if not os.path.exists(imgfilename):
+                raise BHLError("image file/volume '%s' not found" % (imgfilename))
+
+        self.windowsize = max(window * 1024 * 1024, self.maxblocksize)
+        self.windowsize = ((self.windowsize + self.scanstep - 1) //
+                           self.scanstep * self.scanstep)
+        self.skipahead = skipahead
+        self.writefound = writefound
+        self.destpath = destpath
+        self.jobs = jobs
+        if jobs > 1:
+            if not self.hashfilter:
+                raise BHLError("parallel scan needs the hashes filter!")
+            if skipahead:
+                raise BHLError("skip-ahead can't be used with the parallel scan!")
+            self.pool = multiprocessing.Pool(
+                jobs, initializer=scanJobInit,
+                initargs=({"scanstep": self.scanstep,
+                           "sizelist": self.sizelist,
+                           "maxblocksize": self.maxblocksize,
+                           "hashfilter": self.hashfilter,
+                           "weakfilter": self.weakfilter,
+                           "weaksizes": self.weaksizes,
+                           "hashalgos": self.hashalgos,
+                           "constblocks": self.constblocks,
+                           "writefound": writefound},))
+
+        #open all the sources
+        for imgfileid in range(len(self.imgfilenames)):
+            self.fdlist[imgfileid] = os.open(self.imgfilenames[imgfileid],
+                                             os.O_RDONLY |
+                                             getattr(os, "O_BINARY", 0))
+
+    def openOutFile(self, fid):
+        """Get the descriptor of a file written as its blocks are found"""
+        if fid in self.outfds:
+            return self.outfds[fid]
+        if fid in self.outfiles:
+            fdout = createFile(self.outfiles[fid][1], truncate=False)
+        else:
+            fileinfo = self.db.GetFileInfo(fid)
+            filename = os.path.join(self.destpath, fileinfo["filename"])
+            #blocks found before this run (with --resume) are copied first
+            writelist = self.db.GetWriteList(fid)
+            fdout = createFile(filename)
+            counts = {}
+            copied = copyFoundBlocks(fdout, fileinfo["blocksize"], writelist,
+                                     self.fdlist, counts)
+            self.stats.Add(counts)
+            if copied < len(writelist) * fileinfo["blocksize"]:
+                self.unreadable[fid] = (len(writelist) * fileinfo["blocksize"]
+                                        - copied)
+            self.outfiles[fid] = [fileinfo, filename,
+                                  fileinfo["filesize"] // fileinfo["blocksize"] -
+                                  len(writelist)]
+        #don't run out of descriptors with many files found in pieces
+        if len(self.outfds) >= 256:
+            os.close(self.outfds.pop(next(iter(self.outfds))))
+        self.outfds[fid] = fdout
+        return fdout
+
+    def writeBlock(self, fid, num, block):
+        """Write a block just found to its file, and finish it if complete"""
+        fileinfo, filename = self.outfiles[fid][:2]
+        fdout = self.openOutFile(fid)
+        writeData(fdout, num * fileinfo["blocksize"], block)
+        self.outfiles[fid][2] -= 1
+        if self.outfiles[fid][2] == 0:
+            self.filesdone[fid] = finishFile(fdout, fileinfo,
+                                             self.db.GetWriteList(fid))
+            os.close(self.outfds.pop(fid))
+            if fileinfo.get("filedatetime") is not None:
+                os.utime(filename,
+                         (int(time.time()), fileinfo["filedatetime"]))
+
+    def lookup(self, sid, pos, size, digest, block, matches):
+        """Assign a position to the blocks with a given hash, adding them to
+        matches as (fileid, blocknum, sourceid, pos) - return how many"""
+        with self.lock:
+            blocks = self.db.GetHashBlocks(digest)
+            self.stats.Count("db lookups")
+            if not blocks:
+                #a false positive of the filters, or a block already found
+                self.stats.Count("false hits")
+                return 0
+            if self.writefound:
+                for fid, num in blocks:
+                    self.openOutFile(fid)
+            self.db.SetHashPos(fhash=digest, sid=sid, pos=pos)
+            self.blocksfound += len(blocks)
+            self.sizesleft[size] -= len(blocks)
+            self.stats.Count("blocks found", len(blocks))
+            if self.writefound:
+                for fid, num in blocks:
+                    self.writeBlock(fid, num, block)
+            matches.extend([(fid, num, sid, pos) for fid, num in blocks])
+        return len(blocks)
+
+    def scanImage(self, imgfileid, imgfilesize, startpos, status):
+        """Scan an image - yield the blocks found in each window, and if its
+        status (as imgfileid: (percent, MB/s)) has been updated"""
+        imgfilename = self.imgfilenames[imgfileid]
+        db = self.db
+        sizelist = self.sizelist
+        sizesleft = self.sizesleft
+        windowsize = self.windowsize
+        matches = []
+
+        def imgLookup(pos, size, digest, block):
+            return self.lookup(imgfileid, pos, size, digest, block, matches)
+
+        #hashes computed, bytes read, etc.
+        counts = {}
+        if self.pool:
+            #ranges are processed in parallel but merged back in order, so
+            #blocks are assigned as in a sequential scan
+            jobs = [(imgfilename, start, min(start + windowsize, imgfilesize))
+                    for start in range(startpos, imgfilesize, windowsize)]
+            def poolWindows():
+                #just a few windows in flight per worker, so the pool is idle
+                #as soon as the scan stops
+                pending = collections.deque()
+                for job in jobs:
+                    pending.append(self.pool.apply_async(scanJob, (job,)))
+                    if len(pending) < self.jobs * 2:
+                        continue
+                    winpos, scanlen, hits, jobcounts = pending.popleft().get()
+                    self.stats.Add(jobcounts)
+                    yield winpos, scanlen, hits
+                while pending:
+                    winpos, scanlen, hits, jobcounts = pending.popleft().get()
+                    self.stats.Add(jobcounts)
+                    yield winpos, scanlen, hits
+            windows = poolWindows()
+        else:
+            windows = scanWindows(imgfilename, startpos, windowsize,
+                                  self.scanstep, sizelist, self.maxblocksize,
+                                  self.hashfilter, self.weakfilter,
+                                  self.weaksizes, self.hashalgos,
+                                  self.constblocks,
+                                  imgLookup if self.skipahead else None,
+                                  counts=counts)
+
+        stats = self.stats
+        updatetime = time.time() - 1
+        starttime = time.time()
+        docommit = False
+        foundcommitted = self.blocksfound
+
+        try:
+            with stats.Phase("scan", imgfilename):
+                for winpos, scanlen, hits in windows:
+                    updated = False
+                    with self.lock:
+                        with stats.Phase("db lookup"):
+                            for pos, size, digest, block in hits:
+                                if sizesleft[size]:
+                                    imgLookup(pos, size, digest, block)
+                        #the next windows are scanned only for the sizes
+                        #still missing
+                        if [size for size in sizelist if not sizesleft[size]]:
+                            sizelist[:] = [size for size in sizelist
+                                           if sizesleft[size]]
+                        winpos += scanlen
+                        db.SetImagePos(imgfileid, winpos)
+
+                        #status update
+                        now = time.time()
+                        if ((now > updatetime) or
+                            (self.globalblocksnum == self.blocksfound) or
+                            (winpos >= imgfilesize)):
+                            etime = max(now - starttime, .001)
+                            status[imgfileid] = (
+                                min(winpos, imgfilesize)*100/imgfilesize,
+                                (winpos-startpos)/(1024*1024)/etime)
+                            stats.Sample("scan " + imgfilename,
+                                         min(winpos, imgfilesize) - startpos)
+                            updatetime = now + .2
+                            docommit = True
+                            updated = True
+                        #matches and scan position are committed together
+                        if docommit or self.blocksfound > foundcommitted:
+                            with stats.Phase("db commit"):
+                                db.Commit()
+                            docommit = False
+                            foundcommitted = self.blocksfound
+                    found = matches[:]
+                    del matches[:]
+                    yield found, updated
+                    #break early if all the work is done
+                    if (self.blocksfound == self.globalblocksnum or
+                        self.stop.is_set()):
+                        break
+        finally:
+            windows.close()
+            stats.Add(counts)
+
+    def Scan(self, imgfileids=None, concurrent=False, progress=None):
+        """Scan the images (all by default), each from where it was left -
+        yield the blocks found as (fileid, blocknum, sourceid, pos). With
+        concurrent, images on different devices are scanned at once.
+        progress(status) is called from time to time, with status as
+        {imgfileid: (percent done, MB/s)} for the images scanned."""
+        if imgfileids is None:
+            imgfileids = range(len(self.imgfilenames))
+        scanlist = []
+        for imgfileid in imgfileids:
+            imgfilesize = getFileSize(self.imgfilenames[imgfileid])
+            startpos = self.imgstartpos[imgfileid]
+            if startpos >= imgfilesize and startpos > self.offset:
+                continue
+            scanlist.append((imgfileid, imgfilesize, startpos))
+
+        status = {}
+        if not concurrent:
+            for imgfileid, imgfilesize, startpos in scanlist:
+                if self.blocksfound == self.globalblocksnum:
+                    break
+                status.clear()
+                for found, updated in self.scanImage(imgfileid, imgfilesize,
+                                                     startpos, status):
+                    yield from found
+                    if updated and progress:
+                        progress(status)
+            self.endPool()
+            return
+
+        #a thread for each disk, scanning its images one after the other
+        groups = {}
+        for imgfileid, imgfilesize, startpos in scanlist:
+            groups.setdefault(deviceId(self.imgfilenames[imgfileid]), []).append(
+                (imgfileid, imgfilesize, startpos))
+        foundq = queue.Queue()
+        errors = []
+
+        def scanGroup(images):
+            try:
+                for imgfileid, imgfilesize, startpos in images:
+                    if self.blocksfound == self.globalblocksnum:
+                        break
+                    status[imgfileid] = (0, 0)
+                    for found, updated in self.scanImage(imgfileid,
+                                                         imgfilesize,
+                                                         startpos, status):
+                        if found:
+                            foundq.put(found)
+                        if self.stop.is_set():
+                            return
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=scanGroup, args=(images,))
+                   for images in groups.values()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            updatetime = time.time() + .2
+            while threads or not foundq.empty():
+                try:
+                    yield from foundq.get(timeout=.05)
+                except queue.Empty:
+                    pass
+                threads = [thread for thread in threads if thread.is_alive()]
+                if progress and (time.time() > updatetime or not threads):
+                    progress(status)
+                    updatetime = time.time() + .2
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+            self.stop.clear()
+        self.endPool()
+        if errors:
+            raise errors[0]
+
+    def endPool(self):
+        """Stop the scan workers, if all the blocks have been found"""
+        if self.pool and self.blocksfound == self.globalblocksnum:
+            self.pool.terminate()
+            self.pool = None
+
+    def Rebuild(self, destpath="", progress=None):
+        """Rebuild the files with the blocks found (the ones not completed
+        during the scan) - return the number of files restored, restored with
+        errors and missing. progress(event, filename, info) is called for
+        each file, with event as "completed" (during the scan), "creating",
+        "incomplete" (info: blocks missing), "unreadable" (info: bytes of the
+        blocks found that couldn't be read from the images), "error" (info:
+        the OSError), "match", "mismatch" or "missing". The hash checked is
+        the one of the data read back from the file written."""
+        db = self.db
+        if not progress:
+            progress = lambda event, filename, info: None
+        filesrestored = 0
+        filesrestorederr = 0
+        filesmissing = 0
+
+        for fid in range(db.GetFilesNum()):
+            fileinfo = db.GetFileInfo(fid)
+            filename = os.path.join(destpath, fileinfo["filename"])
+            filesize = fileinfo["filesize"]
+
+            #get list of blocks num, positions & hashes
+            blocksize = fileinfo["blocksize"]
+            writelist = db.GetWriteList(fid)
+            totblocksnum = filesize // blocksize
+
+            if fid in self.filesdone or len(writelist) > 0 or totblocksnum == 0:
+                if fid in self.filesdone:
+                    progress("completed", filename, None)
+                    filehash = self.filesdone[fid]
+                else:
+                    progress("creating", filename, None)
+                    if len(writelist) < totblocksnum:
+                        progress("incomplete", filename,
+                                 totblocksnum - len(writelist))
+                    try:
+                        with self.stats.Phase("rebuild", filename):
+                            if fid in self.outfiles:
+                                #blocks already written during the scan
+                                fdout = self.openOutFile(fid)
+                                try:
+                                    filehash = finishFile(fdout, fileinfo,
+                                                          writelist)
+                                finally:
+                                    os.close(self.outfds.pop(fid))
+                            else:
+                                counts = {}
+                                filehash, copied = rebuildFile(
+                                    filename, fileinfo, writelist,
+                                    self.fdlist, counts)
+                                self.stats.Add(counts)
+                                if copied < len(writelist) * blocksize:
+                                    self.unreadable[fid] = (
+                                        len(writelist) * blocksize - copied)
+                            if fileinfo.get("filedatetime") is not None:
+                                os.utime(filename, (int(time.time()),
+                                                    fileinfo["filedatetime"]))
+                    except OSError as e:
+                        progress("error", filename, e)
+                        filehash = None
+                if fid in self.unreadable:
+                    progress("unreadable", filename, self.unreadable[fid])
+                filesrestored += 1
+
+                if filehash == fileinfo["hash"]:
+                    progress("match", filename, None)
+                else:
+                    progress("mismatch", filename, None)
+                    filesrestorederr += 1
+            else:
+                progress("missing", filename, None)
+                filesmissing += 1
+        return filesrestored, filesrestorederr, filesmissing
+
+    def Close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+        for fd in list(self.fdlist.values()) + list(self.outfds.values()):
+            os.close(fd)
+        self.fdlist = {}
+        self.outfds = {}
+
+
+def progressPrinter():
+    """Progress callback printing the percentage done, from time to time"""
+    updatetime = time.time()
+    def showProgress(donesize, totsize):
+        nonlocal updatetime
+        if time.time() > updatetime:
+            print("%.1f%%" % (donesize*100.0/totsize), " ",
+                  end="\r", flush=True)
+            updatetime = time.time() + .1
+    return showProgress
+
+
 def main():
 
     cmdline = get_cmdline()
 
-    globalblocksnum = 0
-    bhlfileid = 0
-    sizelist = []
+    #reports are written at exit, whatever the way
+    stats = Stats()
+    if cmdline.stats:
+        atexit.register(stats.Save, cmdline.stats, program="bhlreco",
+                        version=PROGRAM_VER, args=sys.argv[1:])
+    if cmdline.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(profiler.dump_stats, cmdline.profile)
 
-    if not len(cmdline.imgfilename) and not cmdline.test:
+    if (not len(cmdline.imgfilename) and not cmdline.test and
+        not cmdline.verify and not cmdline.resume):
         errexit(1, "no image file/volume specified!")        
 
     #build list of BHL files to process
@@ -205,242 +1802,169 @@ def main():
     if len(bhlfilenames) == 0:
         errexit(1, "no BHL file(s) found!")
 
-    #prepare database
-    if not cmdline.test:
-        dbfilename = cmdline.dbfilename
-        print("creating '%s' database..." % (dbfilename))
-        if dbfilename.upper() != ":MEMORY:":
-            open(dbfilename, 'w').close()
-        db = RecDB(dbfilename)
-        db.CreateTables()
+    try:
+        if cmdline.test:
+            for bhlfilename in bhlfilenames:
+                print("reading BHL file '%s'..." % bhlfilename)
+                with stats.Phase("bhl parse", bhlfilename):
+                    testBHL(bhlfilename, progressPrinter())
+                print("100%  ", end="\r", flush=True)
+            print("BHL file(s) OK!")
+            errexit(0)
 
-    #process all BHL files
-    for bhlfilename in bhlfilenames:
-        if not os.path.exists(bhlfilename):
-            errexit(1, "BHL file '%s' not found" % (bhlfilename))
-        bhlfilesize = os.path.getsize(bhlfilename)
-
-        #read hashes in memory
-        blocklist = {}
-        print("reading BHL file '%s'..." % bhlfilename)
-        fin = open(bhlfilename, "rb", buffering=1024*1024)
-        if BHL_MAGIC != fin.read(13):
-            errexit(1, "not a valid BHL file")
-        #check ver
-        bhlver = ord(fin.read(1))
-        blocksize = int.from_bytes(fin.read(4), byteorder='big')
-        if not blocksize in sizelist:
-            sizelist.append(blocksize)
-        filesize = int.from_bytes(fin.read(8), byteorder='big')
-        lastblocksize = filesize % blocksize
-        totblocksnum = (filesize + blocksize-1) // blocksize
-
-        #parse metadata section
-        metasize = int.from_bytes(fin.read(4), byteorder='big')
-        metadata = metadataDecode(fin.read(metasize))
-
-        #read all block hashes
-        globalhash = hashlib.sha256()
-        updatetime = time.time() 
-        for block in range(totblocksnum):
-            digest = fin.read(32)
-            globalhash.update(digest)
-            if digest in blocklist:
-                blocklist[digest].append(block)
+        if cmdline.verify:
+            jobs = verifyList(bhlfilenames, cmdline.destpath)
+            if cmdline.jobs > 1:
+                #a sequential read for each file, many files at once
+                pool = multiprocessing.Pool(cmdline.jobs)
+                jobs.sort(key=lambda job: job[2], reverse=True)
+                results = pool.imap_unordered(verifyJob, jobs)
             else:
-                blocklist[digest] = [block]
-            #some progress update
-            if time.time() > updatetime:
-                print("%.1f%%" % (fin.tell()*100.0/bhlfilesize), " ",
-                      end="\r", flush=True)
-                updatetime = time.time() + .1
-
-        lastblockdigest = digest
-
-        #verify the hashes read
-        digest = fin.read(32)
-        if globalhash.digest() != digest:
-            errexit(1, "hashes block corrupt!")
-
-        #read and check last blocks
-        if lastblocksize:
-            totblocksnum -= 1
-            buffer = fin.read(bhlfilesize-fin.tell()+1)
-            lastblockbuffer = zlib.decompress(buffer)
-            blockhash = hashlib.sha256()
-            blockhash.update(lastblockbuffer)
-            if blockhash.digest() != lastblockdigest:
-                errexit(1, "last block corrupt!")
-            #remove lastblock from the list
-            del blocklist[lastblockdigest]
+                def verifyAll():
+                    for job in jobs:
+                        with stats.Phase("verify", job[1]):
+                            result = verifyJob(job, progressPrinter())
+                        yield result
+                results = verifyAll()
+
+            filesok = filesdamaged = filesmissing = fileserr = 0
+            with stats.Phase("verify"):
+                for job, size, damaged, error in results:
+                    filename, filesize, blocksize = job[1:4]
+                    if error:
+                        print("file '%s': %s" % (filename, error))
+                        fileserr += 1
+                        continue
+                    if size is None:
+                        print("file '%s' not found!" % filename)
+                        filesmissing += 1
+                        continue
+                    stats.Add({"bytes read": min(size, filesize),
+                               "blocks verified": -(-filesize // blocksize),
+                               "blocks damaged": sum([last - first + 1 for
+                                                      first, last in damaged])})
+                    if not damaged and size == filesize:
+                        print("file '%s' OK" % filename)
+                        filesok += 1
+                        continue
+                    print("file '%s' damaged!" % filename)
+                    if size != filesize:
+                        print("  size: %i instead of %i" % (size, filesize))
+                    for first, last in damaged:
+                        blocks = ("block %i" % first if first == last else
+                                  "blocks %i-%i" % (first, last))
+                        print("  %s (bytes %i-%i)" %
+                              (blocks, first * blocksize,
+                               min((last + 1) * blocksize, filesize) - 1))
+                    filesdamaged += 1
+            if cmdline.jobs > 1:
+                pool.close()
+                pool.join()
+            print("\nfiles OK: %i - damaged: %i - missing: %i - errors: %i" %
+                  (filesok, filesdamaged, filesmissing, fileserr))
+            errexit(1 if filesdamaged + filesmissing + fileserr else 0)
+
+        #prepare database
+        dbfilename = cmdline.dbfilename
+        if cmdline.resume:
+            print("opening '%s' database..." % (dbfilename))
         else:
-            lastblockbuffer = b""
-        print("100%  ", end="\r", flush=True)
-
-        globalblocksnum += totblocksnum
-
-        #put data in the DB
-        #hashes
-        if not cmdline.test:
-            print("updating db...")
-            updatetime = time.time()
-            i = 0
-            for digest in blocklist:
-                for pos in blocklist[digest]:
-                    db.AddHash(fhash=digest, fid=bhlfileid, fnum=pos)
-                i+= 1
-                #some progress update
-                if time.time() > updatetime:
-                    print("%.1f%%" % (i*100.0/len(blocklist)), " ",
-                          end="\r", flush=True)
-                    db.Commit()
-                    updatetime = time.time() + .1
-                
-            #file info
-            db.SetFileData(fid=bhlfileid, fblocksize=blocksize, fsize=filesize,
-                           fname=metadata["filename"],
-                           fdatetime=metadata["filedatetime"],
-                           flastblock=lastblockbuffer,
-                           fhash=globalhash.digest())
-        bhlfileid +=1
-
-    if cmdline.test:
-        print("BHL file(s) OK!")
-        errexit(0)
-
-    #select an adequate scan step
-    maxblocksize = max(sizelist)
-    scanstep = cmdline.step
-    if scanstep == 0:
-        scanstep = mcd(sizelist)
-    print("scan step:", scanstep)
-    offset = cmdline.offset
-
-    #build list of image files to process
-    imgfilenames = []
-    for filename in cmdline.imgfilename:
-        if os.path.isdir(filename):
-            filename = os.path.join(filename, "*")
-        imgfilenames += glob.glob(filename)
-    imgfilenames = [filename for filename in imgfilenames
-                    if not os.path.isdir(filename)]
-    imgfilenames = sorted(set(imgfilenames))
+            print("creating '%s' database..." % (dbfilename))
+        rec = Recovery(bhlfilenames, dbfilename, cmdline.filtermem,
+                       cmdline.fprate, cmdline.resume, stats, cmdline.weakmem)
 
-    #start scanning process...
-    blocksfound = 0
-    for imgfileid in range(len(imgfilenames)):
-        imgfilename = imgfilenames[imgfileid]
-        if not os.path.exists(imgfilename):
-            errexit(1, "image file/volume '%s' not found" % (imgfilename))
-        imgfilesize = getFileSize(imgfilename)
+        #process all BHL files (already in the DB when resuming)
+        if not cmdline.resume:
+            for bhlfilename in bhlfilenames:
+                print("reading BHL file '%s'..." % bhlfilename)
+                rec.AddBHL(bhlfilename, progressPrinter())
+                print("100%  ", end="\r", flush=True)
+            print("indexing db...")
 
-        print("scanning file '%s'..." % imgfilename)
-        fin = open(imgfilename, "rb", buffering=1024*1024)
+        #build list of image files to process
+        imgfilenames = []
+        for filename in cmdline.imgfilename:
+            if os.path.isdir(filename):
+                filename = os.path.join(filename, "*")
+            imgfilenames += glob.glob(filename)
+        imgfilenames = [filename for filename in imgfilenames
+                        if not os.path.isdir(filename)]
+        imgfilenames = sorted(set(imgfilenames))
 
-        updatetime = time.time() - 1
-        starttime = time.time()
-        writelist = {}
-        docommit = False
+        rec.StartScan(imgfilenames, cmdline.step, cmdline.offset,
+                      cmdline.window, cmdline.jobs, cmdline.skipahead,
+                      cmdline.writefound, cmdline.destpath)
+        print("scan step:", rec.scanstep)
 
-        for pos in range(offset, imgfilesize, scanstep):
-            fin.seek(pos, 0)
-            buffer = fin.read(maxblocksize)
-            if len(buffer) > 0:
-                #need to check for all sizes
-                for size in sizelist:
-                    blockhash = hashlib.sha256()
-                    blockhash.update(buffer[:size])
-                    digest = blockhash.digest()
-                    num = db.SetHashPos(fhash=digest, sid=imgfileid, pos=pos)
-                    if num:
-                        docommit = True
-                        blocksfound += num
-
-                #status update
-                if ((time.time() > updatetime) or (globalblocksnum == blocksfound) or
-                    (imgfilesize-pos-len(buffer) == 0) ):
-                    etime = (time.time()-starttime)
-                    if etime == 0:
-                        etime = .001
-                    print("  %.1f%% - tot: %i - found: %i - %.2fMB/s" %
-                          ((pos+len(buffer)-1)*100/imgfilesize,
-                           globalblocksnum, blocksfound, pos/(1024*1024)/etime),
-                          end = "\r", flush=True)
-                    updatetime = time.time() + .2
-                    if docommit:
-                        db.Commit()
-                        docommit = False
-                    #break early if all the work is done
-                    if blocksfound == globalblocksnum:
-                        break
-        fin.close()
-        print()
-        
-    print("scan completed.")
-
-    filesrestored = 0
-    filesrestorederr = 0
-    filesmissing= 0
-
-    #open all the sources
-    finlist = {}
-    for imgfileid in range(len(imgfilenames)):
-        finlist[imgfileid] = open(imgfilenames[imgfileid], "rb")
-
-    #start rebuilding files...
-    for fid in range(len(bhlfilenames)):
-        fileinfo = db.GetFileInfo(fid)
-        filename = fileinfo["filename"]
-        filename = os.path.join(cmdline.destpath, filename)
-        filesize = fileinfo["filesize"]
-
-        #get list of blocks num & positions
-        blocksize = fileinfo["blocksize"]
-        lastblock = fileinfo["lastblock"]
-        writelist = db.GetWriteList(fid)
-        totblocksnum = filesize // blocksize
-
-        if len(writelist) > 0 or totblocksnum == 0: 
-            print("creating file '%s'..." % filename)
-            open(filename, 'w').close()
-            fout = open(filename, "wb")
-
-            if len(writelist) < totblocksnum:
-                print("file incomplete! block missings: %i" %
-                      (totblocksnum - len(writelist)))
-
-            filehash = hashlib.sha256()
-            for data in writelist:
-                blocknum = data[0]
-                imgid = data[1]
-                pos = data[2]
-                finlist[imgid].seek(pos)
-                buffer = finlist[imgid].read(blocksize)
-                fout.seek(blocknum*blocksize)
-                fout.write(buffer)
-                blockhash = hashlib.sha256()
-                blockhash.update(buffer)
-                filehash.update(blockhash.digest())
-            if lastblock:
-                fout.write(lastblock)
-                blockhash = hashlib.sha256()
-                blockhash.update(lastblock)
-                filehash.update(blockhash.digest())
-            fout.close()
-            if "filedatetime" in fileinfo:
-                os.utime(filename,
-                         (int(time.time()), fileinfo["filedatetime"]))
-            filesrestored += 1
+        def showStatus(status):
+            if not cmdline.concurrent:
+                perc, speed = list(status.values())[0]
+                print("  %.1f%% - tot: %i - found: %i - %.2fMB/s" %
+                      (perc, rec.globalblocksnum, rec.blocksfound, speed),
+                      end = "\r", flush=True)
+            else:
+                print("  tot: %i - found: %i - " %
+                      (rec.globalblocksnum, rec.blocksfound) +
+                      " - ".join(["#%i: %.1f%% %.2fMB/s" %
+                                  ((imgfileid + 1,) + status[imgfileid])
+                                  for imgfileid in sorted(status)]),
+                      end = "\r", flush=True)
 
-            if filehash.digest() == fileinfo["hash"]:
-                print("hash match!")
+        #start scanning process...
+        scanlist = []
+        for imgfileid in range(len(rec.imgfilenames)):
+            #stop early if all the work is done
+            if rec.blocksfound == rec.globalblocksnum:
+                break
+            imgfilename = rec.imgfilenames[imgfileid]
+            startpos = rec.imgstartpos[imgfileid]
+            if startpos >= getFileSize(imgfilename) and startpos > rec.offset:
+                print("file '%s' already scanned" % imgfilename)
+                continue
+            if not cmdline.concurrent:
+                print("scanning file '%s'..." % imgfilename)
+                if startpos > rec.offset:
+                    print("  resuming from %i" % startpos)
+                for match in rec.Scan([imgfileid], progress=showStatus):
+                    pass
+                print()
             else:
-                print("hash mismatch! decoded file corrupted/incomplete!")
-                filesrestorederr += 1
+                print("scanning file '%s' (#%i)..." % (imgfilename,
+                                                       imgfileid + 1))
+                if startpos > rec.offset:
+                    print("  resuming from %i" % startpos)
+                scanlist.append(imgfileid)
+        if scanlist:
+            for match in rec.Scan(scanlist, concurrent=True,
+                                  progress=showStatus):
+                pass
+            print()
+        print("scan completed.")
 
-        else:
-            print("nothing found for file '%s'" % filename)
-            filesmissing += 1
+        #start rebuilding files (the ones not already completed)...
+        messages = {"completed": "file '%s' completed during the scan",
+                    "creating": "creating file '%s'...",
+                    "incomplete": "file incomplete! block missings: %i",
+                    "unreadable": "%i bytes of the blocks found couldn't be read!",
+                    "error": "error writing the file: %s",
+                    "match": "hash match!",
+                    "mismatch": "hash mismatch! decoded file corrupted/incomplete!",
+                    "missing": "nothing found for file '%s'"}
+
+        def showFile(event, filename, info):
+            if event in ("incomplete", "unreadable", "error"):
+                print(messages[event] % info)
+            elif "%s" in messages[event]:
+                print(messages[event] % filename)
+            else:
+                print(messages[event])
+
+        filesrestored, filesrestorederr, filesmissing = rec.Rebuild(
+            cmdline.destpath, showFile)
+        rec.Close()
+
+    except BHLError as e:
+        errexit(1, str(e))
 
     print("\nfiles restored: %i - with errors: %i - files missing: %i" %
           (filesrestored, filesrestorederr, filesmissing))